@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import argparse
+import BaseHTTPServer, SocketServer, logging, threading, time, urlparse, sys
+import connect_api
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive like connect, every reply takes the same fixed time
+    protocol_version = 'HTTP/1.1'
+    delay = 0.2
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        if query.get('action') == 'common-info':
+            body = '<common><cookie>check</cookie><version>9</version><account account-id="1"/></common>'
+        elif query.get('action') == 'principal-info':
+            body = '<principal principal-id="%s" type="user"><name>check</name></principal>' % query.get('principal-id')
+        else:
+            body = ''
+
+        time.sleep(self.delay)
+        body = '<results><status code="ok"/>%s</results>' % body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class SlowServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    pass
+
+def timed(api, calls, threads):
+    todo = range(calls)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not todo:
+                    return
+                item = todo.pop()
+            api.principal_info(str(item))
+
+    start = time.time()
+    pool = [threading.Thread(target=worker) for i in xrange(threads)]
+    for item in pool:
+        item.start()
+    for item in pool:
+        item.join()
+
+    return time.time() - start
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='check that one shared ConnectAPI scales with threads against a slow local stub',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--delay', default=0.2, type=float,
+                        help='stub reply time in seconds')
+    parser.add_argument('-c', '--calls', default=32, type=int,
+                        help='principal-info calls per run')
+    parser.add_argument('-t', '--threads', default=[1, 2, 4, 8], type=int, nargs='+',
+                        help='thread counts to compare')
+    parser.add_argument('-e', '--efficiency', default=0.75, type=float,
+                        help='lowest acceptable speedup per thread relative to one thread')
+    args = parser.parse_args(argv)
+
+    SlowHandler.delay = args.delay
+    server = SlowServer(('127.0.0.1', 0), SlowHandler)
+    serve = threading.Thread(target=server.serve_forever)
+    serve.daemon = True
+    serve.start()
+
+    # connect_api only configures logging when nothing else has
+    logging.basicConfig(level=logging.INFO)
+    api = connect_api.ConnectAPI('127.0.0.1:%d' % server.server_address[1], 'check', 'check', insecure=True, timeout=10)
+
+    # every call is cache-free and waits on the stub, so throughput should grow with the thread count
+    base = None
+    failed = []
+    for threads in args.threads:
+        took = timed(api, args.calls, threads)
+        base = base or took * args.threads[0]
+        speedup = base / took
+        ok = speedup >= threads * args.efficiency
+        print '%2d thread(s): %d calls in %.2fs, speedup %.2f %s' % (threads, args.calls, took, speedup, ok and 'ok' or 'FAIL')
+        if not ok:
+            failed.append(threads)
+
+    print 'connections: %s' % api.connection_stats()
+    # closing the pooled keep-alive sockets lets the handler threads finish before exit
+    for con in api.pool.idle:
+        con.close()
+    server.shutdown()
+    sys.exit(failed and 1 or 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,11 @@
 #!/usr/bin/python
 
 import logging as log
-import httplib, urllib, signal
-from xml.etree.cElementTree import fromstring as parseXML, tostring as buildXML, Element
+import collections, httplib, urllib, socket, threading, time, Queue
+from xml.etree.cElementTree import fromstring as parseXML, tostring as buildXML, iterparse, Element
 
 class ConnectError(Exception):
     def __init__(self, xml, *args):
-        signal.alarm(0)
         self.args = args
         self.code = xml.find('status').get('code')
 
@@ -52,14 +51,268 @@ class ConnectPrincipal(object):
         self.info = dict((item.tag, item.text) for item in xml)
 
 
+class ConnectPool(object):
+    def __init__(self, httpconn, hostname, timeout=None, size=8):
+        self.httpconn = httpconn
+        self.hostname = hostname
+        self.timeout = timeout
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'retried': 0, 'closed': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get(self, deadline=None):
+        with self.lock:
+            if self.idle:
+                self.stats['reused'] += 1
+                return self.idle.pop(), True
+
+            self.stats['created'] += 1
+        return self.httpconn(host=self.hostname, timeout=self.arm(None, deadline)), False
+
+    def put(self, con):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(con)
+                return
+
+            self.stats['closed'] += 1
+        con.close()
+
+    def arm(self, con, deadline):
+        # socket timeout is whichever is sooner: the per-operation limit or what is left of the request
+        wait = self.timeout
+        if deadline is not None:
+            wait = deadline - time.time()
+            if wait <= 0:
+                raise socket.timeout('request deadline exceeded')
+            wait = self.timeout and min(self.timeout, wait) or wait
+
+        if con is not None:
+            con.timeout = wait
+            if con.sock is not None:
+                con.sock.settimeout(wait)
+
+        return wait
+
+    def send(self, con, method, uri, body, headers, deadline):
+        self.arm(con, deadline)
+        con.request(method, uri, body, headers)
+
+        self.arm(con, deadline)
+        return con.getresponse()
+
+    def open(self, method, uri, body=None, headers={}, deadline=None):
+        con, reused = self.get(deadline)
+        try:
+            res = self.send(con, method, uri, body, headers, deadline)
+        except socket.timeout:
+            con.close()
+            raise
+        except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+            con.close()
+            if not reused:
+                raise
+
+            # the server dropped an idle keep-alive socket, retry once on a fresh one
+            log.debug('stale connection to %s, reconnecting', self.hostname)
+            self.count('retried')
+            self.count('created')
+
+            con = self.httpconn(host=self.hostname, timeout=self.arm(None, deadline))
+            res = self.send(con, method, uri, body, headers, deadline)
+
+        return ConnectReader(self, con, res, deadline)
+
+    def release(self, reader, done=True):
+        # a partly read response leaves the socket unusable for the next request
+        if not done or reader.res.will_close:
+            self.count('closed')
+            reader.con.close()
+        else:
+            self.put(reader.con)
+
+    def request(self, method, uri, body=None, headers={}, deadline=None):
+        reader = self.open(method, uri, body, headers, deadline)
+        try:
+            txt = []
+            while True:
+                txt.append(reader.read(65536))
+                if not txt[-1]:
+                    break
+        except:
+            self.release(reader, False)
+            raise
+
+        self.release(reader)
+        return reader.status, ''.join(txt)
+
+
+class ConnectReader(object):
+    def __init__(self, pool, con, res, deadline=None):
+        self.pool = pool
+        self.con = con
+        self.res = res
+        self.status = res.status
+        self.deadline = deadline
+        self.wait = None
+
+    def read(self, size=65536):
+        # with a per-read wait each read gets the whole of it, time spent by the consumer is not counted
+        self.pool.arm(self.con, self.wait and time.time() + self.wait or self.deadline)
+        return self.res.read(size)
+
+
+class ConnectBulk(object):
+    min_size = 1
+    max_size = 200
+    latency = 2.0
+    retries = 3
+
+    def __init__(self, api, action, items, workers=4, size=10):
+        self.api = api
+        self.action = action
+        self.items = items
+        self.workers = workers
+        self.size = size
+        self.cursor = 0
+        self.flight = 0
+        self.retry = []
+        self.results = [None] * len(items)
+        self.cond = threading.Condition()
+
+    def next(self):
+        with self.cond:
+            while True:
+                if self.retry:
+                    self.flight += 1
+                    return self.retry.pop(0)
+
+                if self.cursor < len(self.items):
+                    batch = range(self.cursor, min(self.cursor + self.size, len(self.items)))
+                    self.cursor += len(batch)
+                    self.flight += 1
+                    return batch, 0
+
+                if not self.flight:
+                    return None
+
+                self.cond.wait()
+
+    def send(self, batch):
+        xml = Element('params')
+        for indx in batch:
+            for key, val in self.items[indx].items():
+                xml.append(Element('param', name=key))
+                xml[len(xml) - 1].text = val
+
+        xml.append(Element('param', name='action'))
+        xml[len(xml) - 1].text = self.action
+
+        return self.api.request(submit=buildXML(xml))
+
+    def worker(self):
+        for batch, tries in iter(self.next, None):
+            init = time.time()
+            try:
+                self.send(batch)
+                fail = None
+            except Exception as e:
+                fail = e
+            spent = time.time() - init
+
+            with self.cond:
+                if fail is None:
+                    for indx in batch:
+                        self.results[indx] = True
+
+                    # grow batches while the server answers quickly, shrink them when it slows down
+                    if spent < self.latency / 2:
+                        self.size = min(self.size * 2, self.max_size)
+                    elif spent > self.latency:
+                        self.size = max(self.size / 2, self.min_size)
+                else:
+                    log.debug('bulk %s batch of %d failed: %s', self.action, len(batch), fail)
+                    self.size = max(self.size / 2, self.min_size)
+
+                    # split failed batches to isolate bad items, give up on single items after retries
+                    if len(batch) > 1:
+                        self.retry.extend([(batch[:len(batch) / 2], tries), (batch[len(batch) / 2:], tries)])
+                    elif tries + 1 < self.retries:
+                        self.retry.append((batch, tries + 1))
+                    else:
+                        self.results[batch[0]] = fail
+
+                self.flight -= 1
+                self.cond.notifyAll()
+
+    def run(self):
+        pool = [threading.Thread(target=self.worker) for i in xrange(self.workers)]
+        for item in pool:
+            item.daemon = True
+            item.start()
+        for item in pool:
+            item.join()
+
+        return self.results
+
+
+class ConnectCache(object):
+    ttls = {
+        'common-info': 60,
+        'custom-fields': 3600,
+        'principal-info': 300,
+        'principal-list-by-field': 300,
+    }
+
+    def __init__(self, size=10000, ttls={}):
+        self.size = size
+        self.ttls = dict(self.ttls, **ttls)
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def key(self, params):
+        if params.get('action') in self.ttls:
+            return tuple(sorted((k, v) for k, v in params.items() if v is not None))
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.stats['misses'] += 1
+                return None
+
+            # re-insert to mark as most recently used
+            self.data[key] = item
+            self.stats['hits'] += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (time.time() + self.ttls[dict(key)['action']], value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, action, **match):
+        with self.lock:
+            for key in [k for k in self.data if dict(k)['action'] == action and all(dict(k).get(n) == v for n, v in match.items())]:
+                del self.data[key]
+                self.stats['invalidations'] += 1
+
+
 class ConnectAPI(object):
-    def __init__(self, hostname, username, password, insecure=False, timeout=None):
+    def __init__(self, hostname, username, password, insecure=False, timeout=None, cache=None):
         # log configuration is a noop if already configured
         log.basicConfig(format='%(asctime)s.%(msecs)03d - %(funcName)10s:%(lineno)-3d - %(levelname)10s: %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S', level=log.DEBUG)
 
-        signal.signal(signal.SIGALRM, self.timeout)
-
         self.httpconn = insecure and httplib.HTTPConnection or httplib.HTTPSConnection
         log.debug('using %s http connection: %s', insecure and 'insecure' or 'secure', self.httpconn)
 
@@ -68,55 +321,148 @@ class ConnectAPI(object):
         self.password = password
         self.timeout = timeout
         self.session = None
+        self.logins = 0
+        self.relogin = threading.Lock()
+        self.pool = ConnectPool(self.httpconn, hostname, timeout)
+        self.cache = cache is True and ConnectCache() or cache or None
         self.login()
 
-    def timeout(self, *args):
-        self.error('request-timeout', 'timeout after %ds processing request: %s', self.timeout, self.uri)
-
-    def request(self, submit=None, **params):
-        if self.timeout:
-            signal.alarm(self.timeout)
+    def request(self, submit=None, timeout=None, renew=True, cache=True, **params):
+        # every call carries its own deadline so one client can be shared between threads
+        timeout = timeout or self.timeout
+        deadline = timeout and time.time() + timeout or None
 
         params['session'] = self.session
+        logins = self.logins
 
-        self.uri = '/api/xml?' + urllib.urlencode(dict((k.replace('_', '-'), v) for k, v in params.items() if v is not None))
-        log.debug('from %s requesting uri %s', self.hostname, self.uri)
+        key = not submit and self.cache and self.cache.key(params)
+        if key and cache:
+            xml = self.cache.get(key)
+            if xml is not None:
+                log.debug('from %s cached %s', self.hostname, params['action'])
+                return xml
 
-        con = self.httpconn(host=self.hostname, timeout=self.timeout)
+        uri = '/api/xml?' + urllib.urlencode(dict((k.replace('_', '-'), v) for k, v in params.items() if v is not None))
+        log.debug('from %s requesting uri %s', self.hostname, uri)
 
-        if submit:
-            log.debug('using POST with data: %s', submit)
-            hdr = {'Content-type': 'application/xml'}
-            con.request('POST', self.uri, submit, hdr)
-        else:
-            log.debug('using GET')
-            con.request('GET', self.uri)
+        try:
+            if submit:
+                log.debug('using POST with data: %s', submit)
+                hdr = {'Content-type': 'application/xml'}
+                status, txt = self.pool.request('POST', uri, submit, hdr, deadline)
+            else:
+                log.debug('using GET')
+                status, txt = self.pool.request('GET', uri, deadline=deadline)
+        except socket.timeout:
+            self.error('request-timeout', 'timeout after %gs processing request: %s', timeout, uri)
 
-        res = con.getresponse()
-        log.debug('received response code: %d', res.status)
+        log.debug('received response code: %d', status)
 
-        if res.status != 200:
-            self.error('invalid-http', 'bad http response: %d for request: %s', res.status, self.uri)
+        if status != 200:
+            self.error('invalid-http', 'bad http response: %d for request: %s', status, uri)
 
-        txt = res.read()
-        log.debug('received response body: %s', txt.decode('utf8'))
+        log.debug('received response body: %s', txt)
 
         xml = parseXML(txt)
+        if renew and self.expired(xml.find('status'), params.get('action'), logins):
+            return self.request(submit, timeout, False, cache, **params)
         if xml.find('status').get('code') != 'ok':
-            raise ConnectError(xml, 'invalid xml response: %s for request: %s', xml.find('status').get('code'), self.uri)
+            raise ConnectError(xml, 'invalid xml response: %s for request: %s', xml.find('status').get('code'), uri)
+
+        xml = len(xml) == 1 and True or xml
+        if key:
+            self.cache.put(key, xml)
+
+        return xml
+
+    def invalidate(self, action, **match):
+        if self.cache:
+            self.cache.invalidate(action, **match)
 
-        signal.alarm(0)
-        return len(xml) == 1 and True or xml
+    def cache_stats(self):
+        if self.cache:
+            with self.cache.lock:
+                return dict(self.cache.stats, size=len(self.cache.data))
+
+    def connection_stats(self):
+        with self.pool.lock:
+            return dict(self.pool.stats, idle=len(self.pool.idle))
+
+    def stream(self, tag, timeout=None, renew=True, **params):
+        timeout = timeout or self.timeout
+        deadline = timeout and time.time() + timeout or None
+
+        params['session'] = self.session
+        logins = self.logins
+
+        uri = '/api/xml?' + urllib.urlencode(dict((k.replace('_', '-'), v) for k, v in params.items() if v is not None))
+        log.debug('from %s streaming uri %s', self.hostname, uri)
+
+        try:
+            reader = self.pool.open('GET', uri, deadline=deadline)
+        except socket.timeout:
+            self.error('request-timeout', 'timeout after %gs processing request: %s', timeout, uri)
+
+        # the deadline covers connect and response headers, the body may take as long as the caller does
+        reader.wait = timeout
+        done = False
+        retry = False
+        try:
+            log.debug('received response code: %d', reader.status)
+            if reader.status != 200:
+                self.error('invalid-http', 'bad http response: %d for request: %s', reader.status, uri)
+
+            # yield matching elements as they arrive and drop them once the caller is done
+            path = []
+            for event, item in iterparse(reader, ('start', 'end')):
+                if event == 'start':
+                    path.append(item)
+                    continue
+
+                path.pop()
+                if item.tag == 'status' and renew and self.expired(item, params.get('action'), logins):
+                    retry = True
+                    break
+                elif item.tag == 'status' and item.get('code') != 'ok':
+                    xml = parseXML('<results>%s</results>' % buildXML(item))
+                    raise ConnectError(xml, 'invalid xml response: %s for request: %s', item.get('code'), uri)
+                elif item.tag == tag:
+                    yield item
+                    del path[-1][:]
+
+            done = True
+        except socket.timeout:
+            self.error('request-timeout', 'timeout after %gs processing request: %s', timeout, uri)
+        finally:
+            self.pool.release(reader, done)
+
+        # status precedes any results, so nothing has been yielded yet when the session expired
+        if retry:
+            for item in self.stream(tag, timeout, False, **params):
+                yield item
 
     def error(self, code, *args):
         xml = parseXML('<results><status code="%s"/></results>' % code)
         raise ConnectError(xml, *args)
 
+    def expired(self, status, action, logins):
+        if status.get('code') != 'no-access' or status.get('subcode') != 'no-login' or action in ('common-info', 'login'):
+            return False
+
+        # log in again once per expiry, however many threads notice it at the same time
+        with self.relogin:
+            if self.logins == logins:
+                log.debug('connect session %s expired, logging in again', self.session)
+                self.login()
+        return True
+
     def login(self):
-        self.session = self.common_info().cookie
+        # a cached common-info would hand back the cookie of the session being replaced
+        self.session = ConnectInfo(self.request(action='common-info', cache=False)).cookie
         log.debug('extracted connect session id: %s', self.session)
 
         self.request(action='login', login=self.username, password=self.password)
+        self.logins += 1
 
     def common_info(self):
         return ConnectInfo(self.request(action='common-info'))
@@ -134,10 +480,28 @@ class ConnectAPI(object):
         xml = self.request(action='principal-list', principal_id=principal_id, group_id=group_id, **arg)
         return [ConnectPrincipal(item) for item in xml.find('principal-list')]
 
+    def iter_principal_list(self, principal_id=None, group_id=None, page=1000, **filters):
+        arg = dict(('filter_' + k, v) for k, v in filters.items() if k in self.principal_list.allowed_filters)
+        start = 0
+        while True:
+            count = 0
+            for item in self.stream('principal', action='principal-list', principal_id=principal_id, group_id=group_id,
+                                    filter_start=start, filter_rows=page, **arg):
+                count += 1
+                yield ConnectPrincipal(item)
+
+            if count < page:
+                break
+            start += page
+
     def principal_list_by_field(self, field_id, value):
         xml = self.request(action='principal-list-by-field', field_id=field_id, value=value)
         return [ConnectPrincipal(item) for item in xml.find('principal-list')]
         
+    def iter_principal_list_by_field(self, field_id, value):
+        for item in self.stream('principal', action='principal-list-by-field', field_id=field_id, value=value):
+            yield ConnectPrincipal(item)
+
     def principal_update(self, **params):
         xml = Element('params')
         xml.append(Element('param', name='action'))
@@ -149,6 +513,10 @@ class ConnectAPI(object):
                 xml[len(xml) - 1].text = val
 
         xml = self.request(submit=buildXML(xml))
+
+        self.invalidate('principal-info', principal_id=params.get('principal_id'))
+        self.invalidate('principal-list-by-field')
+        self.invalidate('principal-list')
         return type(xml) == type(Element(None)) and ConnectPrincipal(xml.find('principal')) or xml
         
     def update_group(self, name, login, principal_id=None):
@@ -159,34 +527,86 @@ class ConnectAPI(object):
                                      first_name=first_name, last_name=last_name, password=password,
                                      has_children='false', send_email='false')
 
-    def bulk_action(self, action, data):
-        ret = 0
-        xml = Element('params')
-        while len(data):
-            for key, val in data.pop().items():
-                xml.append(Element('param', name=key))
-                xml[len(xml) - 1].text = val
-
-            if len(xml) >= 30 or len(data) == 0:
-                xml.append(Element('param', name='action'))
-                xml[len(xml) - 1].text = action
-
-                ret += self.request(submit=buildXML(xml))
-                xml.clear()
-
-        return ret
+    def bulk_action(self, action, data, workers=4, size=10):
+        try:
+            return ConnectBulk(self, action, data, workers, size).run()
+        finally:
+            if action == 'acl-field-update':
+                self.invalidate('principal-info')
+                self.invalidate('principal-list-by-field')
+            if action == 'group-membership-update':
+                self.invalidate('principal-list')
 
     def group_membership_update(self, principal_id, group_id, is_member='true'):
-        return self.request(action='group-membership-update', principal_id=principal_id, group_id=group_id, is_member=is_member)
-
-    def bulk_group_membership_update(self, data):
-        return self.bulk_action('group-membership-update', [{'principal-id': p, 'group-id': g, 'is-member': m} for p, g, m in data])
+        try:
+            return self.request(action='group-membership-update', principal_id=principal_id, group_id=group_id, is_member=is_member)
+        finally:
+            self.invalidate('principal-list', group_id=group_id)
+            self.invalidate('principal-list', principal_id=principal_id)
+
+    def bulk_group_membership_update(self, data, **kwargs):
+        return self.bulk_action('group-membership-update', [{'principal-id': p, 'group-id': g, 'is-member': m} for p, g, m in data], **kwargs)
+
+    def group_members(self, group_ids, workers=4):
+        todo = list(group_ids)
+        found = {}
+        fail = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not todo or fail:
+                        return
+                    group = todo.pop()
+                try:
+                    items = set(i.id for i in self.iter_principal_list(group_id=group, is_member='true'))
+                except Exception as e:
+                    with lock:
+                        fail.append(e)
+                    return
+                with lock:
+                    found[group] = items
+
+        pool = [threading.Thread(target=worker) for i in xrange(workers)]
+        for item in pool:
+            item.daemon = True
+            item.start()
+        for item in pool:
+            item.join()
+
+        if fail:
+            raise fail[0]
+        return found
+
+    def sync_group_membership(self, desired, workers=4, dry_run=False):
+        # only groups named in the desired mapping are touched, members outside it are left alone
+        current = self.group_members(desired, workers)
+        delta = dict((g, (set(desired[g]) - current[g], current[g] - set(desired[g]))) for g in desired)
+
+        for group, (add, remove) in sorted(delta.items()):
+            if add or remove:
+                log.info('group %s: %d member(s), +%d -%d', group, len(current[group]), len(add), len(remove))
+        log.info('membership delta: +%d -%d across %d group(s)%s', sum(len(i[0]) for i in delta.values()),
+                 sum(len(i[1]) for i in delta.values()), len(delta), dry_run and ' (dry run)' or '')
+
+        if dry_run:
+            return delta, None
+
+        data = [(p, g, 'true') for g, (add, remove) in delta.items() for p in add]
+        data.extend((p, g, 'false') for g, (add, remove) in delta.items() for p in remove)
+
+        return delta, dict(zip(data, self.bulk_group_membership_update(data, workers=workers)))
 
     def acl_field_update(self, acl_id, field_id, value):
-        return self.request(action='acl-field-update', acl_id=acl_id, field_id=field_id, value=value)
+        try:
+            return self.request(action='acl-field-update', acl_id=acl_id, field_id=field_id, value=value)
+        finally:
+            self.invalidate('principal-info', principal_id=acl_id)
+            self.invalidate('principal-list-by-field', field_id=field_id)
 
-    def bulk_acl_field_update(self, data):
-        return self.bulk_action('acl-field-update', [{'acl-id': a, 'field-id': f, 'value': v} for a, f, v in data])
+    def bulk_acl_field_update(self, data, **kwargs):
+        return self.bulk_action('acl-field-update', [{'acl-id': a, 'field-id': f, 'value': v} for a, f, v in data], **kwargs)
 
     principal_list.allowed_filters = (
         'type', 'name', 'email', 'login', 'is_member'
@@ -196,6 +616,96 @@ class ConnectAPI(object):
     )
 
 
+class ConnectFuture(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.fail = None
+
+    def set(self, value=None, fail=None):
+        self.value = value
+        self.fail = fail
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise socket.timeout('result not ready after %gs' % timeout)
+        if self.fail is not None:
+            raise self.fail
+        return self.value
+
+
+class ConnectAsync(object):
+    actions = (
+        'common_info', 'custom_fields', 'principal_info', 'principal_list', 'principal_list_by_field',
+        'principal_update', 'update_group', 'update_user', 'group_membership_update', 'acl_field_update',
+        'bulk_action', 'bulk_group_membership_update', 'bulk_acl_field_update', 'group_members',
+        'sync_group_membership'
+    )
+
+    def __init__(self, api, limit=16):
+        # every call is queued and run by at most limit workers sharing the session and connections of api
+        self.api = api
+        self.limit = limit
+        self.queue = Queue.Queue()
+        self.api.pool.size = max(self.api.pool.size, limit)
+
+        self.pool = [threading.Thread(target=self.worker) for i in xrange(limit)]
+        for item in self.pool:
+            item.daemon = True
+            item.start()
+
+    def __getattr__(self, name):
+        if name not in self.actions:
+            raise AttributeError(name)
+        func = getattr(self.api, name)
+        return lambda *args, **kwargs: self.submit(func, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        future = ConnectFuture()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def worker(self):
+        for future, func, args, kwargs in iter(self.queue.get, None):
+            try:
+                future.set(func(*args, **kwargs))
+            except Exception as e:
+                future.set(fail=e)
+
+    def gather(self, futures, timeout=None):
+        # results in submission order, failed calls hold their exception like bulk results do
+        deadline = timeout and time.time() + timeout or None
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(deadline and max(deadline - time.time(), 0)))
+            except socket.timeout:
+                raise
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def map(self, action, items, timeout=None):
+        func = getattr(self, action)
+        return self.gather([func(*(isinstance(i, tuple) and i or (i,))) for i in items], timeout)
+
+    def close(self):
+        for item in self.pool:
+            self.queue.put(None)
+        for item in self.pool:
+            item.join()
+
+
 if __name__ == '__main__':
     import sys, getpass, optparse
 
@@ -1,15 +1,38 @@
 #!/opt/python/bin/python2.7
 
 import argparse
+import collections
+import ctypes
+import ctypes.util
+import datetime
 import errno
+import io
+import itertools
+import json
+import mmap
 import os
+import Queue
 import re
 import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import traceback
 import xml.etree.cElementTree as etree
+from stat import S_ISDIR
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+Block = collections.namedtuple('Block', ['id', 'genstamp', 'meta_size', 'size', 'subdir'])
 
 def check_root():
     if os.geteuid() != 0:
@@ -52,56 +75,448 @@ def path_usage(path):
         'total': util.f_blocks * util.f_frsize,
     }
 
-def rebalancer(src, tgt, num, vbs=False, dry=False):
-    if vbs:
-        print 'moving %d bytes from %s to %s' % (num, src, ', '.join(tgt))
+def kernel_copy():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return []
+
+    # both advance the file offsets, so a copy can carry on with the next one where the last gave up
+    funcs = []
+    if hasattr(libc, 'copy_file_range'):
+        libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        libc.copy_file_range.restype = ctypes.c_ssize_t
+        funcs.append(lambda src, dst, num: libc.copy_file_range(src, None, dst, None, num, 0))
+
+    if hasattr(libc, 'sendfile'):
+        libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+        libc.sendfile.restype = ctypes.c_ssize_t
+        funcs.append(lambda src, dst, num: libc.sendfile(dst, src, None, num))
+
+    return funcs
+
+COPY_FUNCS = kernel_copy()
+COPY_SIZE = mmap.PAGESIZE * 2048
+COPY_SKIP = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+def copy_file(src, dst, funcs=COPY_FUNCS):
+    stat = os.stat(src)
+    part = '%s/.%s.part' % os.path.split(dst)
+    done = 0
+
+    with io.open(src, 'rb', buffering=0) as fsrc, io.open(part, 'wb', buffering=0) as fdst:
+        # let the kernel move the pages, copy_file_range refuses cross filesystem copies on many kernels so
+        # sendfile picks up from there, userspace copy is the last resort
+        for func in funcs:
+            while done < stat.st_size:
+                size = func(fsrc.fileno(), fdst.fileno(), min(COPY_SIZE, stat.st_size - done))
+                if size < 0 and ctypes.get_errno() not in COPY_SKIP:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), src)
+                if size <= 0:
+                    break
+                done += size
+
+        if done < stat.st_size:
+            fsrc.seek(done)
+            fdst.seek(done)
+
+            buff = mmap.mmap(-1, COPY_SIZE)
+            try:
+                size = fsrc.readinto(buff)
+                while size:
+                    fdst.write(buffer(buff, 0, size))
+                    size = fsrc.readinto(buff)
+            finally:
+                buff.close()
 
-    dest = 0
-    move = 0
-    for root, dirs, files in os.walk('%s/current' % src):
-        for meta in files:
-            if meta.startswith('blk') and meta.endswith('.meta'):
-                blck = '_'.join(meta.split('_')[:-1])
+        os.fsync(fdst.fileno())
+
+    os.chown(part, stat.st_uid, stat.st_gid)
+    shutil.copystat(src, part)
+    os.rename(part, dst)
+    sync_dir(os.path.dirname(dst))
+
+    return stat.st_size
+
+def sync_dir(path):
+    # the source is unlinked on another filesystem, so the new directory entry has to be on disk first
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class MoveStats(object):
+    def __init__(self, num):
+        self.lock = threading.Lock()
+        self.num  = num
+        self.move = 0
+        self.done = []
+        self.init = time.time()
+
+    def add(self, size, item=None):
+        with self.lock:
+            self.move += size
+            if item is not None:
+                self.done.append(item)
+
+    def rate(self):
+        return self.move / max(time.time() - self.init, 0.001) / 1048576
+
+    def show(self, text, *args):
+        with self.lock:
+            print text % args
+
+    def line(self, text, *args):
+        with self.lock:
+            sys.stdout.write(text % args)
+
+def mirror_dirs(root, dest):
+    if os.path.isdir(dest):
+        return
+
+    # create missing parents first, each owned like its source counterpart
+    mirror_dirs(os.path.dirname(root), os.path.dirname(dest))
+
+    stat = os.stat(root)
+    try:
+        os.mkdir(dest)
+        os.chown(dest, stat.st_uid, stat.st_gid)
+        shutil.copystat(root, dest)
+        sync_dir(os.path.dirname(dest))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
+def move_block(root, meta, blck, dest):
+    mirror_dirs(root, dest)
+
+    # the datanode loads replicas from blk_ files and ignores a meta on its own, so the block rename commits the copy
+    size  = copy_file('%s/%s' % (root, meta), '%s/%s' % (dest, meta))
+    size += copy_file('%s/%s' % (root, blck), '%s/%s' % (dest, blck))
+
+    # drop the source block first for the same reason, a leftover meta is harmless
+    os.unlink('%s/%s' % (root, blck))
+    os.unlink('%s/%s' % (root, meta))
+
+    return size
+
+def reconcile_move(item, src, tgt):
+    root = block_dir(src, item)
+    dest = block_dir(tgt, item)
+    meta, blck = block_names(item)
+
+    for name in blck, meta:
+        if os.path.exists('%s/.%s.part' % (dest, name)):
+            os.unlink('%s/.%s.part' % (dest, name))
+
+    # a fully copied target replica means only the source unlink was lost
+    if all(os.path.exists('%s/%s' % (dest, name)) and os.path.getsize('%s/%s' % (dest, name)) == size for name, size in ((blck, item.size), (meta, item.meta_size))):
+        for name in blck, meta:
+            if os.path.exists('%s/%s' % (root, name)):
+                os.unlink('%s/%s' % (root, name))
+        return True
+
+    for name in blck, meta:
+        if os.path.exists('%s/%s' % (dest, name)):
+            os.unlink('%s/%s' % (dest, name))
+    return False
+
+class MoveJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = None
+
+    def resume(self):
+        if not os.path.exists(self.path):
+            return [], []
+
+        jobs = []
+        pend = {}
+        done = set()
+        with open(self.path) as data:
+            for line in data:
                 try:
-                    size = os.stat('%s/%s' % (root, meta)).st_size + os.stat('%s/%s' % (root, blck)).st_size
-                    if vbs:
-                        print '\tmoving %d bytes: %s/%s, %s/%s to %s' % (size, root, meta, root, blck, tgt[dest])
-                    else:
-                        print '\rmoving %d / %d bytes from %s to %s ... %.02f%%' % (move, num, src, ', '.join(tgt), float(move) / num * 100),
-
-                    if not dry:
-                        if not os.path.exists(tgt[dest]):
-                            stat = os.stat(root)
-                            os.makedirs(tgt[dest])
-                            os.chown(tgt[dest], stat.st_uid, stat.st_gid)
-                            shutil.copystat(root, tgt[dest])
-
-                        meta_stat = os.stat('%s/%s' % (root, meta))
-                        blck_stat = os.stat('%s/%s' % (root, blck))
-
-                        shutil.copy2('%s/%s' % (root, meta), tgt[dest])
-                        shutil.copy2('%s/%s' % (root, blck), tgt[dest])
-
-                        os.chown('%s/%s' % (tgt[dest], meta), meta_stat.st_uid, meta_stat.st_gid)
-                        os.chown('%s/%s' % (tgt[dest], blck), blck_stat.st_uid, meta_stat.st_gid)
-
-                        os.unlink('%s/%s' % (root, meta))
-                        os.unlink('%s/%s' % (root, blck))
-
-                    dest = (dest + 1) % len(tgt)
-                    move += size
-
-                    if move >= num:
-                        if vbs:
-                            print '%d / %d bytes moved' % (move, num)
-                        else:
-                            print '\rmoved %d / %d bytes from %s to %s ... %.02f%%' % (move, num, src, ', '.join(tgt), float(move) / num * 100)
-                        return
+                    item = json.loads(line)
+                except ValueError:
+                    # torn tail from a crash mid-append
+                    continue
+
+                if item['op'] == 'plan':
+                    jobs = [(Block(*i[0]), i[1], i[2]) for i in item['jobs']]
+                elif item['op'] == 'intent':
+                    pend[item['job']] = True
+                elif item['op'] in ('commit', 'abort'):
+                    pend.pop(item['job'], None)
+                    if item['op'] == 'commit':
+                        done.add(item['job'])
+
+        for indx in sorted(pend):
+            item, src, tgt = jobs[indx]
+            if reconcile_move(item, src, tgt):
+                print '\tcompleted interrupted move of blk_%s from %s to %s' % (item.id, src, tgt)
+                done.add(indx)
+            else:
+                print '\trolled back interrupted move of blk_%s from %s to %s' % (item.id, src, tgt)
+
+        return [j for i, j in enumerate(jobs) if i not in done], [j for i, j in enumerate(jobs) if i in done]
+
+    def begin(self, jobs):
+        with open('%s.part' % self.path, 'w') as data:
+            data.write(json.dumps({'op': 'plan', 'jobs': jobs}) + '\n')
+            data.flush()
+            os.fsync(data.fileno())
+        os.rename('%s.part' % self.path, self.path)
+
+        self.data = open(self.path, 'a')
+
+    def write(self, op, indx):
+        with self.lock:
+            self.data.write(json.dumps({'op': op, 'job': indx}) + '\n')
+            self.data.flush()
+            os.fsync(self.data.fileno())
+
+    def close(self):
+        self.data.close()
+        os.unlink(self.path)
+
+def balance_plan(util, factor):
+    mean = sum(i['util'] for i in util.values()) / len(util)
+    over = sorted(((k, int(v['total'] * (v['util'] - mean) / 100)) for k, v in util.items() if v['util'] > mean), key=lambda k: -k[1])
+    want = sorted(((k, int(v['total'] * (mean - v['util']) / 100)) for k, v in util.items() if mean - v['util'] > factor / (len(util) - 1)), key=lambda k: -k[1])
+
+    # greedily pair the fullest sources with the emptiest targets
+    plan = {}
+    over = [list(i) for i in over]
+    want = [list(i) for i in want]
+    while over and want:
+        size = min(over[0][1], want[0][1])
+        if size > 0:
+            plan.setdefault(over[0][0], {})[want[0][0]] = size
+
+        over[0][1] -= size
+        want[0][1] -= size
+        if over[0][1] <= 0:
+            over.pop(0)
+        if want[0][1] <= 0:
+            want.pop(0)
+
+    return plan
+
+def plan_report(plan, util, rate):
+    flow = dict((i, [0, 0]) for i in util)
+    print 'calculated transfer plan:'
+    for src, tgt in sorted(plan.items()):
+        for dest, size in sorted(tgt.items()):
+            print '\t%s -> %s: %d bytes' % (src, dest, size)
+            flow[src][0] += size
+            flow[dest][1] += size
+
+    # every volume is a single spindle, so the busiest one bounds the run
+    print 'estimated volume transfers: (%.02f MB/s per volume)' % rate
+    for path, (sent, recv) in sorted(flow.items()):
+        print '\t%s: %d bytes out, %d bytes in, %s' % (path, sent, recv, datetime.timedelta(seconds=int((sent + recv) / rate / 1048576)))
+    print '\ttotal: %d bytes, %s' % (sum(i[0] for i in flow.values()), datetime.timedelta(seconds=int(max(sum(i) for i in flow.values()) / rate / 1048576)))
+
+def move_worker(jobs, stat, vbs=False, dry=False, jrnl=None):
+    for indx, (item, src, tgt) in iter(jobs.get, None):
+        root = block_dir(src, item)
+        dest = block_dir(tgt, item)
+        meta, blck = block_names(item)
+        try:
+            if vbs:
+                stat.show('\tmoving %d bytes: %s/%s, %s/%s to %s', item.meta_size + item.size, root, meta, root, blck, dest)
+
+            if not dry:
+                if jrnl:
+                    jrnl.write('intent', indx)
+                move_block(root, meta, blck, dest)
+                if jrnl:
+                    jrnl.write('commit', indx)
+
+            stat.add(item.meta_size + item.size, (item, src, tgt))
+        except Exception as e:
+            stat.show('%sfailed to move %s/%s, %s/%s: %s', '\t' if vbs else '\n', root, meta, root, blck, e)
+            if jrnl:
+                try:
+                    done = reconcile_move(item, src, tgt)
+                    if done:
+                        stat.add(item.meta_size + item.size, (item, src, tgt))
+                    jrnl.write('commit' if done else 'abort', indx)
                 except Exception as e:
-                    print '%sfailed to move %s/%s, %s/%s: %s' % ('\t' if vbs else '\n', root, meta, root, blck, e)
-    if not vbs:
-        print
+                    stat.show('%sfailed to reconcile %s/%s, %s/%s: %s', '\t' if vbs else '\n', root, meta, root, blck, e)
+
+def block_names(item):
+    return 'blk_%s_%s.meta' % (item.id, item.genstamp), 'blk_%s' % item.id
+
+def block_dir(vol, item):
+    return os.path.normpath('%s/current/%s' % (vol, item.subdir))
+
+def list_dir(path):
+    if scandir is not None:
+        for item in scandir(path):
+            if item.is_dir(follow_symlinks=False):
+                yield item.name, True, 0
+            elif item.name.startswith('blk_'):
+                yield item.name, False, item.stat(follow_symlinks=False).st_size
+    else:
+        for name in os.listdir(path):
+            stat = os.lstat('%s/%s' % (path, name))
+            yield name, S_ISDIR(stat.st_mode), stat.st_size
+
+def scan_volume(vol, blocks):
+    dirs = ['']
+    while dirs:
+        subdir = dirs.pop()
+        files = {}
+        for name, isdir, size in list_dir(os.path.normpath('%s/current/%s' % (vol, subdir))):
+            if isdir:
+                dirs.append(os.path.join(subdir, name))
+            elif name.startswith('blk_'):
+                files[name] = size
+
+        for name, size in files.iteritems():
+            if name.endswith('.meta'):
+                ident, stamp = name[4:-5].rsplit('_', 1)
+                if 'blk_' + ident in files:
+                    blocks.append(Block(ident, stamp, size, files['blk_' + ident], subdir))
+
+def layout_benchmark(path, count, rounds=3):
+    base = tempfile.mkdtemp(prefix='balance_dn.', dir=path)
+    try:
+        for name, shard in ('flat', lambda i: ''), ('sharded', lambda i: 'subdir%d/subdir%d' % (i >> 16 & 0x1f, i >> 8 & 0x1f)):
+            sys.stdout.write('building %s layout of %d blocks in %s ...' % (name, count, base))
+            for indx in xrange(count):
+                root = os.path.normpath('%s/%s/current/%s' % (base, name, shard(indx)))
+                if not os.path.isdir(root):
+                    os.makedirs(root)
+                open('%s/blk_%d' % (root, indx), 'w').close()
+                open('%s/blk_%d_1001.meta' % (root, indx), 'w').close()
+
+            best = None
+            for i in xrange(rounds):
+                init = time.time()
+                scan_volume('%s/%s' % (base, name), [])
+                best = min(best or sys.maxint, time.time() - init)
+            print '\r%s layout of %d blocks scanned in %.03fs (best of %d)' % (name, count, best, rounds)
+    finally:
+        shutil.rmtree(base)
+
+def volume_stamp(vol):
+    # any block written, deleted or re-stamped since the inventory was saved changes used bytes or inodes
+    util = os.statvfs(vol)
+    return [(util.f_blocks - util.f_bfree) * util.f_frsize, util.f_files - util.f_ffree]
+
+def block_inventory(dirs, path=None):
+    if path and os.path.exists(path):
+        with open(path) as data:
+            data = json.load(data)
+        if data.get('usage') == dict((i, volume_stamp(i)) for i in dirs):
+            print 'loaded block inventory from %s' % path
+            return dict((k, [Block(*i) for i in v]) for k, v in data['blocks'].iteritems())
+        print 'block inventory %s is stale, rescanning' % path
+
+    inv = dict((i, []) for i in dirs)
+    scan = [threading.Thread(target=scan_volume, args=(i, inv[i])) for i in dirs]
+    for item in scan:
+        item.daemon = True
+        item.start()
+    for item in scan:
+        while item.is_alive():
+            item.join(1)
+            sys.stdout.write('\rscanning %d volume(s) ... %d blocks' % (len(dirs), sum(len(i) for i in inv.values())))
+    print '\rscanned %d volume(s) ... %d blocks' % (len(dirs), sum(len(i) for i in inv.values()))
+
+    if path:
+        save_inventory(inv, path)
+
+    return inv
+
+def save_inventory(inv, path):
+    with open('%s.part' % path, 'w') as data:
+        json.dump({'blocks': inv, 'usage': dict((i, volume_stamp(i)) for i in inv)}, data)
+    os.rename('%s.part' % path, path)
+
+def select_blocks(blocks, plan):
+    need = dict(plan)
+    pick = []
+
+    # largest blocks first keeps the per-file overhead down, smaller ones fill the remainder
+    for item in sorted(blocks, key=lambda k: k.meta_size + k.size, reverse=True):
+        if not need:
+            break
+
+        dest = max(need, key=need.get)
+        if item.meta_size + item.size > need[dest]:
+            continue
+
+        pick.append((item, dest))
+        need[dest] -= item.meta_size + item.size
+        if need[dest] <= 0:
+            del need[dest]
+
+    return pick
+
+def plan_blocks(plan, inv):
+    jobs = [[(item, src, dest) for item, dest in select_blocks(inv[src], plan[src])] for src in plan]
+
+    # interleave sources so every spindle is busy from the start
+    return [i for i in itertools.chain.from_iterable(itertools.izip_longest(*jobs)) if i is not None]
+
+def rebalancer(job, vbs=False, dry=False, workers=0, jrnl=None):
+    src = set(i[1] for i in job)
+    tgt = set(i[2] for i in job)
+    num = sum(i[0].meta_size + i[0].size for i in job) or 1
+    if vbs:
+        print 'moving %d bytes in %d blocks from %s to %s' % (num, len(job), ', '.join(sorted(src)), ', '.join(sorted(tgt)))
+
+    if jrnl:
+        jrnl.begin(job)
+
+    jobs = Queue.Queue()
+    stat = MoveStats(num)
+    pool = [threading.Thread(target=move_worker, args=(jobs, stat, vbs, dry, jrnl)) for i in xrange(workers or len(tgt))]
+    for item in pool:
+        item.daemon = True
+        item.start()
+
+    for item in enumerate(job):
+        jobs.put(item)
+    for item in pool:
+        jobs.put(None)
+
+    for item in pool:
+        while item.is_alive():
+            item.join(1)
+            if not vbs:
+                stat.line('\rmoving %d / %d bytes across %d volume(s) ... %.02f%% (%.02f MB/s)',
+                          stat.move, num, len(src | tgt), float(stat.move) / num * 100, stat.rate())
+
+    if vbs:
+        print '%d / %d bytes moved (%.02f MB/s)' % (stat.move, num, stat.rate())
+    else:
+        print '\rmoved %d / %d bytes across %d volume(s) ... %.02f%% (%.02f MB/s)' % (stat.move, num, len(src | tgt), float(stat.move) / num * 100, stat.rate())
+
+    if jrnl:
+        jrnl.close()
+
+    return stat.done
+
+def update_inventory(inv, done):
+    moved = collections.defaultdict(dict)
+    for item, src, dest in done:
+        moved[src][item] = dest
+
+    # one pass per source volume, membership tests against the moved set instead of the list
+    for src, items in moved.items():
+        keep = []
+        for item in inv[src]:
+            if item in items:
+                inv[items.pop(item)].append(item)
+            else:
+                keep.append(item)
+        inv[src] = keep
 
 
 if __name__ == '__main__':
@@ -110,17 +525,33 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='datanode volume balancer', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-b', '--balance', default=5, type=float,
                         help='balance percentage factor')
+    parser.add_argument('-B', '--benchmark', nargs=2, metavar=('DIR', 'BLOCKS'),
+                        help='compare scan time of flat and subdir sharded layouts in DIR')
     parser.add_argument('-c', '--cfg-dir', default='/etc/hadoop/conf',
                         help='hadoop configuration directory')
     parser.add_argument('-p', '--mtx-prt', default=1123, type=int,
                         help='local runtime mutex port')
+    parser.add_argument('-i', '--inventory',
+                        help='block inventory file to reuse and refresh while the datanode stays down, keep it off the data volumes')
+    parser.add_argument('-j', '--journal', default='/var/tmp/balance_dn.journal',
+                        help='move journal used to recover and resume an interrupted balance, empty to disable')
     parser.add_argument('-n', '--dry-run', default=False, action='store_true',
                         help='report usage without performing balance')
+    parser.add_argument('-P', '--plan-only', default=False, action='store_true',
+                        help='report transfer plan without scanning blocks')
+    parser.add_argument('-r', '--rate', default=100, type=float,
+                        help='expected MB/s per volume for plan estimates')
     parser.add_argument('-v', '--verbose', default=False, action='store_true',
                         help='report blocks being moved instead of percentage')
+    parser.add_argument('-w', '--workers', default=0, type=int,
+                        help='concurrent copy workers, 0 for one per target volume')
     args = parser.parse_args()
 
-    if not args.dry_run:
+    if args.benchmark:
+        layout_benchmark(args.benchmark[0], int(args.benchmark[1]))
+        sys.exit(0)
+
+    if not args.dry_run and not args.plan_only:
         check_root()
         check_java()
         mutex_lock(args.mtx_prt)
@@ -129,23 +560,40 @@ if __name__ == '__main__':
 
     print 'discovered block volumes:'
     print '\t', ', '.join(dirs)
-    while True:
-        util = dict((i, path_usage(i)) for i in dirs)
-        mean = sum(i['util'] for i in util.values()) / len(util)
 
-        print 'calculated volume usage: (%.02f%% mean)' % mean
-        print '\t', ', '.join('%s: %.02f%%' % (k, v['util']) for k, v in sorted(util.items()))
+    jrnl = MoveJournal(args.journal) if args.journal and not args.dry_run else None
+    jobs, done = jrnl.resume() if jrnl and not args.plan_only else ([], [])
 
-        orig, used = max(((i, j) for i, j in util.items()), key=lambda k: k[1]['util'])
-        dest = list('%s/current' % i for i, j in util.items() if mean - j['util'] > args.balance / (len(util) - 1))
-        size = int(used['total'] * (used['util'] - mean) / 100)
+    if jobs:
+        print 'resuming %d block move(s) from %s' % (len(jobs), args.journal)
+        inv = block_inventory(dirs, args.inventory) if args.inventory and os.path.exists(args.inventory) else None
+        if inv is not None:
+            update_inventory(inv, done)
+    else:
+        util = dict((i, path_usage(i)) for i in dirs)
+        print 'calculated volume usage: (%.02f%% mean)' % (sum(i['util'] for i in util.values()) / len(util))
+        print '\t', ', '.join('%s: %.02f%%' % (k, v['util']) for k, v in sorted(util.items()))
 
-        if not dest:
+        plan = balance_plan(util, args.balance)
+        if not plan:
             print 'volumes are balanced to +/- %.02f%%' % args.balance
-            break
+            sys.exit(0)
 
-        rebalancer(orig, dest, size, args.verbose, args.dry_run)
+        plan_report(plan, util, args.rate)
+        if args.plan_only:
+            sys.exit(0)
 
-        if args.dry_run:
-            print 'dry run is set, skipping re-check to avoid infinite loop'
-            break
+        inv = block_inventory(dirs, args.inventory)
+        update_inventory(inv, done)
+        jobs = plan_blocks(plan, inv)
+
+    done = rebalancer(jobs, args.verbose, args.dry_run, args.workers, jrnl)
+
+    if not args.dry_run:
+        if args.inventory and inv is not None:
+            update_inventory(inv, done)
+            save_inventory(inv, args.inventory)
+
+        util = dict((i, path_usage(i)) for i in dirs)
+        print 'rebalanced volume usage: (%.02f%% mean)' % (sum(i['util'] for i in util.values()) / len(util))
+        print '\t', ', '.join('%s: %.02f%%' % (k, v['util']) for k, v in sorted(util.items()))
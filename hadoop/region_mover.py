@@ -3,8 +3,10 @@
 import glob
 import optparse
 import os
+import Queue
 import socket
 import sys
+import threading
 import time
 
 import java.io.File
@@ -13,6 +15,7 @@ import java.lang.String
 import java.lang.reflect.UndeclaredThrowableException
 import java.net.URL
 import java.net.URLClassLoader
+import java.util.ArrayList
 
 ### prepare classpath
 load = java.net.URLClassLoader.getDeclaredMethod('addURL', [java.net.URL])
@@ -40,6 +43,9 @@ import org.apache.hadoop.hbase.client.Scan
 import org.apache.hadoop.hbase.filter.FirstKeyOnlyFilter
 
 import org.apache.hadoop.hbase.zookeeper.RootRegionTracker
+import org.apache.hadoop.hbase.zookeeper.ZKAssign
+import org.apache.hadoop.hbase.zookeeper.ZKUtil
+import org.apache.hadoop.hbase.zookeeper.ZooKeeperListener
 
 import org.apache.commons.logging.Log
 import org.apache.commons.logging.LogFactory
@@ -77,10 +83,13 @@ def get_config(params={}, zk_hosts=[]):
 def get_servers(admin, src, dst):
     target = dict((s.getServerName().split(',')[0], s.getServerName()) for s in admin.getClusterStatus().getServerInfo())
 
-    if src not in target:
-        raise RuntimeError('%s is not online' % src)
-    else:
-        source = target.pop(src)
+    # every source leaves the target pool, even if it is drained by someone else
+    source = []
+    for host in src:
+        if host not in target:
+            raise RuntimeError('%s is not online' % host)
+        else:
+            source.append(target.pop(host))
 
     return source, target.values() if not len(dst) else [s for s in target.values() if s.split(',')[0] in dst]
 
@@ -94,108 +103,558 @@ def get_regions(config, source):
 
 def get_region_server(admin, region):
     if region.isRootRegion():
-        tracker = org.apache.hadoop.hbase.zookeeper.RootRegionTracker(admin.getConnection().getZooKeeperWatcher(), RegionMoverAbortable())
-        tracker.start()
-        while not tracker.isLocationAvailable():
-            time.sleep(0.1)
-
-        server = tracker.getRootRegionLocation().toString() + ','
-        tracker.stop()
+        location = get_root_tracker(admin).waitRootRegionLocation(admin.getConfiguration().getInt('hbase.move.wait.max', 60) * 1000)
+        if location is None:
+            raise RuntimeError('Root region location unavailable')
 
-        return server
+        return location.toString() + ','
 
     if region.isMetaRegion():
         table = get_table(admin.getConfiguration(), HConstants.ROOT_TABLE_NAME)
     else:
         table = get_table(admin.getConfiguration(), HConstants.META_TABLE_NAME)
 
+    return catalog_server(table.get(catalog_get(region)))
+
+def catalog_get(region):
     get = org.apache.hadoop.hbase.client.Get(region.getRegionName())
     get.addColumn(HConstants.CATALOG_FAMILY, HConstants.SERVER_QUALIFIER)
     get.addColumn(HConstants.CATALOG_FAMILY, HConstants.STARTCODE_QUALIFIER)
 
-    result = table.get(get)
+    return get
+
+def catalog_server(result):
     server = result.getValue(HConstants.CATALOG_FAMILY, HConstants.SERVER_QUALIFIER)
     start_code = result.getValue(HConstants.CATALOG_FAMILY, HConstants.STARTCODE_QUALIFIER)
 
     return '%s,%d' % (java.lang.String(server).replaceFirst(':', ','), Bytes.toLong(start_code))
 
-def get_table(config, table, cache={}):
-    key = Bytes.toString(table)
-    if key not in cache:
-        cache[key] = org.apache.hadoop.hbase.client.HTable(config, table)
+def get_root_tracker(admin, cache={}):
+    # one long-lived tracker, its zookeeper watch wakes waiters instead of polling
+    if 'root' not in cache:
+        tracker = org.apache.hadoop.hbase.zookeeper.RootRegionTracker(admin.getConnection().getZooKeeperWatcher(), RegionMoverAbortable())
+        tracker.start()
+        cache['root'] = tracker
+
+    return cache['root']
 
-    return cache[key]
+def get_table(config, table, cache=threading.local()):
+    # HTable is not thread safe, so every mover thread keeps its own
+    key = Bytes.toString(table)
+    if not hasattr(cache, 'tables'):
+        cache.tables = {}
+    if key not in cache.tables:
+        cache.tables[key] = org.apache.hadoop.hbase.client.HTable(config, table)
+
+    return cache.tables[key]
+
+def scan_region(admin, region, level='probe', rows=1, families=[], budget=0):
+    scan = org.apache.hadoop.hbase.client.Scan(region.getStartKey(), region.getEndKey())
+    if level == 'probe':
+        scan.setBatch(1)
+        scan.setCaching(1)
+        scan.setFilter(org.apache.hadoop.hbase.filter.FirstKeyOnlyFilter())
+        rows = 1
+    else:
+        scan.setCaching(level == 'rows' and min(rows, 1000) or 1000)
+        for family in families:
+            scan.addFamily(Bytes.toBytes(family))
 
-def scan_region(admin, region):
-    scan = org.apache.hadoop.hbase.client.Scan(region.getStartKey())
-    scan.setBatch(1)
-    scan.setCaching(1)
-    scan.setFilter(org.apache.hadoop.hbase.filter.FirstKeyOnlyFilter())
+    until = budget and time.time() + budget
+    count = 0
 
     table = get_table(admin.getConfiguration(), region.tableName)
     scanner = table.getScanner(scan)
     try:
-        scanner.next()
+        while level == 'full' or count < rows:
+            if scanner.next() is None:
+                break
+            count += 1
+
+            if until and time.time() > until:
+                break
     finally:
         scanner.close()
         table.close()
 
-def move_region(admin, region, source, target):
-    admin.move(Bytes.toBytes(region.getEncodedName()), Bytes.toBytes(target))
+    return count
+
+class RegionWarmer(object):
+    budgets = {'probe': 10, 'rows': 30, 'full': 300}
+
+    def __init__(self, admin, threads=1, level='probe', rows=1000, families=[], budget=None):
+        self.admin = admin
+        self.level = level
+        self.rows = rows
+        self.families = families
+        self.budget = budget or self.budgets[level]
+        self.lock = threading.Lock()
+        self.count = [0, 0]
+
+        self.queue = Queue.Queue()
+        self.pool = [threading.Thread(target=self.worker) for i in xrange(max(threads, 1))]
+        for item in self.pool:
+            item.setDaemon(True)
+            item.start()
+
+    def worker(self):
+        for region in iter(self.queue.get, None):
+            init = time.time()
+            try:
+                rows = scan_region(self.admin, region, self.level, self.rows, self.families, self.budget)
+                LOG.info('warmed region %-32s (%s, %d row(s) in %.1fs)' % (region.getEncodedName(), self.level, rows, time.time() - init))
+                state = 0
+            except (Exception, java.lang.Exception), e:
+                LOG.warn('Exception warming %s: %s' % (region.getEncodedName(), e))
+                state = 1
+
+            self.lock.acquire()
+            try:
+                self.count[state] += 1
+            finally:
+                self.lock.release()
+
+    def submit(self, region):
+        self.queue.put(region)
+
+    def close(self):
+        for item in self.pool:
+            self.queue.put(None)
+        for item in self.pool:
+            item.join()
+
+        LOG.info('Warmed %d region(s) at level %s; %d failed' % (self.count[0], self.level, self.count[1]))
+
+class RegionTracker(threading.Thread):
+    def __init__(self, admin):
+        threading.Thread.__init__(self, name='region-tracker')
+        self.setDaemon(True)
+
+        self.admin = admin
+        self.cond = threading.Condition()
+        self.regions = {}
+        self.location = {}
+
+        # poll interval in ms, doubled on every tick where nothing moved
+        self.min = admin.getConfiguration().getInt('hbase.move.poll.min', 100) / 1000.0
+        self.max = admin.getConfiguration().getInt('hbase.move.poll.max', 2000) / 1000.0
+        self.interval = self.min
+        self.added = False
+
+    def wait(self, region, source, until):
+        name = region.getEncodedName()
+
+        self.cond.acquire()
+        try:
+            self.regions[name] = region
+            self.interval = self.min
+            self.added = True
+            self.cond.notifyAll()
+
+            while time.time() < until:
+                server = self.location.get(name)
+                if server is not None and server != source:
+                    return server
+                self.cond.wait(max(until - time.time(), 0.001))
+        finally:
+            del self.regions[name]
+            self.location.pop(name, None)
+            self.cond.release()
+
+    def lookup(self, regions):
+        found = {}
+        batch = {}
+        for region in regions:
+            if region.isRootRegion():
+                found[region.getEncodedName()] = get_region_server(self.admin, region)
+            else:
+                batch.setdefault(region.isMetaRegion() and 'root' or 'meta', []).append(region)
+
+        # one multi-get per catalog table covers every region in flight
+        for name, items in batch.items():
+            table = get_table(self.admin.getConfiguration(), name == 'root' and HConstants.ROOT_TABLE_NAME or HConstants.META_TABLE_NAME)
+            results = table.get(java.util.ArrayList([catalog_get(i) for i in items]))
+            for region, result in zip(items, results):
+                try:
+                    found[region.getEncodedName()] = catalog_server(result)
+                except (Exception, java.lang.Exception), e:
+                    LOG.debug('No location for %s yet: %s' % (region.getEncodedName(), e))
+
+        return found
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.regions:
+                    self.cond.wait()
+                regions = self.regions.values()
+                self.added = False
+            finally:
+                self.cond.release()
+
+            try:
+                found = self.lookup(regions)
+            except (Exception, java.lang.Exception), e:
+                LOG.warn('Catalog lookup failed for %d region(s): %s' % (len(regions), e))
+                found = {}
+
+            self.cond.acquire()
+            try:
+                moved = [k for k, v in found.items() if k in self.regions and self.location.get(k) != v]
+                self.location.update((k, found[k]) for k in moved)
+                self.interval = moved and self.min or min(self.interval * 2, self.max)
+                self.cond.notifyAll()
+
+                # back off between lookups, but a newly registered region is looked up straight away
+                until = time.time() + self.interval
+                while not self.added and time.time() < until:
+                    self.cond.wait(until - time.time())
+            finally:
+                self.cond.release()
+
+class TransitionTracker(org.apache.hadoop.hbase.zookeeper.ZooKeeperListener):
+    def __init__(self, admin):
+        self.zkw = admin.getConnection().getZooKeeperWatcher()
+        org.apache.hadoop.hbase.zookeeper.ZooKeeperListener.__init__(self, self.zkw)
+
+        self.cond = threading.Condition()
+        self.nodes = {}
+
+        # seconds to wait for an unassigned node before falling back to catalog polling
+        self.quiet = admin.getConfiguration().getInt('hbase.move.wait.quiet', 5)
+
+        self.zkw.registerListener(self)
+
+    def path(self, region):
+        return org.apache.hadoop.hbase.zookeeper.ZKAssign.getNodeName(self.zkw, region.getEncodedName())
+
+    def register(self, region):
+        self.cond.acquire()
+        try:
+            self.nodes[self.path(region)] = [False, False]
+        finally:
+            self.cond.release()
+
+        self.update(self.path(region))
+
+    def discard(self, region):
+        self.cond.acquire()
+        try:
+            self.nodes.pop(self.path(region), None)
+        finally:
+            self.cond.release()
+
+    def update(self, path):
+        if path not in self.nodes:
+            return
+
+        # watches fire once, so re-arm on every event and check where the node stands
+        exists = org.apache.hadoop.hbase.zookeeper.ZKUtil.watchAndCheckExists(self.zkw, path)
+
+        self.cond.acquire()
+        try:
+            node = self.nodes.get(path)
+            if node is not None:
+                if exists:
+                    node[0] = True
+                elif node[0]:
+                    node[1] = True
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def nodeCreated(self, path):
+        self.update(path)
 
+    def nodeDeleted(self, path):
+        self.update(path)
+
+    def nodeDataChanged(self, path):
+        self.update(path)
+
+    def wait(self, region, until):
+        quiet = time.time() + self.quiet
+
+        self.cond.acquire()
+        try:
+            node = self.nodes[self.path(region)]
+            while not node[1] and time.time() < (node[0] and until or min(until, quiet)):
+                self.cond.wait(max((node[0] and until or min(until, quiet)) - time.time(), 0.001))
+
+            return node[1]
+        finally:
+            self.cond.release()
+
+def move_region(admin, region, source, target, tracker, events=None):
     until = time.time() + admin.getConfiguration().getInt('hbase.move.wait.max', 60)
-    while time.time() < until:
-        if get_region_server(admin, region) != source:
-            break
 
-        time.sleep(0.1)
-    else:
+    if events:
+        events.register(region)
+    try:
+        admin.move(Bytes.toBytes(region.getEncodedName()), Bytes.toBytes(target))
+
+        # the unassigned node going away marks the end of the transition, confirm once in the catalog
+        if events and events.wait(region, until) and get_region_server(admin, region) != source:
+            return
+    finally:
+        if events:
+            events.discard(region)
+
+    if tracker.wait(region, source, until) is None:
         raise RuntimeError('Region stuck on %s, target=%s' % (source, target))
 
-    scan_region(admin, region)
+class LoadPlacement(object):
+    def __init__(self, admin):
+        self.load = {}
+        self.size = {}
+
+        # one cluster status snapshot, kept current with running totals afterwards
+        status = admin.getClusterStatus()
+        for info in status.getServerInfo():
+            # 0.90 hands out HServerInfo, 0.92+ a ServerName whose load lives on the status
+            load = hasattr(info, 'getLoad') and info.getLoad() or status.getLoad(info)
+            items = load.getRegionsLoad()
+            for item in hasattr(items, 'values') and items.values() or items:
+                self.size[item.getNameAsString()] = item.getStorefileSizeMB() + item.getMemStoreSizeMB()
+            self.load[info.getServerName()] = [float(load.getNumberOfRegions()), float(load.getNumberOfRequests())]
+
+        sizes = [i for i in self.size.values() if i > 0]
+        self.mean_size = sizes and float(sum(sizes)) / len(sizes) or 0
+        self.mean_load = [float(sum(i[n] for i in self.load.values())) / max(len(self.load), 1) for n in (0, 1)]
+
+    def weight(self, region):
+        # an average sized region counts as one, unknown sizes count as average
+        size = self.size.get(region.getRegionNameAsString(), 0)
+        return self.mean_size and size and size / self.mean_size or 1.0
+
+    def score(self, server):
+        regions, reqs = self.load.get(server, [0.0, 0.0])
+        return sum(self.mean_load[n] and (regions, reqs)[n] / self.mean_load[n] or 0 for n in (0, 1))
+
+    def pick(self, targets, region):
+        target = min(targets, key=self.score)
+        self.add(target, region)
+
+        return target
+
+    def add(self, server, region, sign=1):
+        self.load.setdefault(server, [0.0, 0.0])[0] += sign * self.weight(region)
+
+class MoveScheduler(object):
+    def __init__(self, admin, parallel=1, per_target=0, placement=None, warmer=None):
+        self.admin = admin
+        self.parallel = max(parallel, 1)
+        self.per_target = per_target
+        self.placement = placement
+        self.warmer = warmer
+        self.cond = threading.Condition()
+        self.flight = {}
+        self.status = {}
+        self.totals = {}
+        self.init = time.time()
+
+        self.tracker = RegionTracker(admin)
+        self.tracker.start()
+
+        self.events = None
+        if admin.getConfiguration().getBoolean('hbase.move.wait.events', True):
+            self.events = TransitionTracker(admin)
+
+    def acquire(self, targets, count, region):
+        self.cond.acquire()
+        try:
+            # keep round-robin order but skip targets already at their in-flight limit
+            while True:
+                ready = [targets[(count + i) % len(targets)] for i in xrange(len(targets))]
+                ready = [i for i in ready if not self.per_target or self.flight.get(i, 0) < self.per_target]
+                if ready:
+                    target = self.placement and self.placement.pick(ready, region) or ready[0]
+                    self.flight[target] = self.flight.get(target, 0) + 1
+                    return target
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def release(self, target):
+        self.cond.acquire()
+        try:
+            self.flight[target] -= 1
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
 
-def unload_regions(args, sources, targets=[]):
+    def record(self, region, state, source, target, init, error=None):
+        self.cond.acquire()
+        try:
+            if state != 'moved' and self.placement:
+                self.placement.add(target, region, -1)
+            self.status[region.getEncodedName()] = (state, source, target, time.time() - init, error)
+
+            states = [i[0] for i in self.status.values() if i[1] == source]
+            LOG.info('source %s: %d of %d region(s) done, %d moved, %d failed, %d timed out' % (
+                source, len(states), self.totals[source], states.count('moved'), states.count('failed'), states.count('timeout')))
+        finally:
+            self.cond.release()
+
+    def worker(self, jobs):
+        for count, total, region, source, targets in iter(jobs.get, None):
+            target = self.acquire(targets, count, region)
+            init = time.time()
+
+            LOG.info('moving region %-32s (%4d of %4d) to server=%s' % (region.getEncodedName(), count + 1, total, target))
+            try:
+                try:
+                    move_region(self.admin, region, source, target, self.tracker, self.events)
+                    self.record(region, 'moved', source, target, init)
+                    if self.warmer:
+                        self.warmer.submit(region)
+                except RuntimeError, e:
+                    LOG.error('Timeout moving %s: %s' % (region.getEncodedName(), e))
+                    self.record(region, 'timeout', source, target, init, e)
+                except java.lang.reflect.UndeclaredThrowableException, e:
+                    LOG.error('Exception moving %s; split/moved? %s' % (region.getEncodedName(), e))
+                    self.record(region, 'failed', source, target, init, e)
+                except (Exception, java.lang.Exception), e:
+                    LOG.error('Exception moving %s: %s' % (region.getEncodedName(), e))
+                    self.record(region, 'failed', source, target, init, e)
+            finally:
+                self.release(target)
+
+    def run(self, jobs):
+        for region, source, targets in jobs:
+            self.totals[source] = self.totals.get(source, 0) + 1
+
+        queue = Queue.Queue()
+        for count in xrange(len(jobs)):
+            queue.put((count, len(jobs)) + tuple(jobs[count]))
+
+        pool = [threading.Thread(target=self.worker, args=(queue,)) for i in xrange(min(self.parallel, len(jobs)))]
+        for item in pool:
+            queue.put(None)
+            item.setDaemon(True)
+            item.start()
+        for item in pool:
+            item.join()
+
+        if self.warmer:
+            self.warmer.close()
+
+    def summary(self):
+        elapsed = time.time() - self.init
+        states = [i[0] for i in self.status.values()]
+
+        LOG.info('Moved %d of %d region(s) in %.1fs (%.2f regions/s); %d failed, %d timed out' % (
+            states.count('moved'), len(states), elapsed, states.count('moved') / max(elapsed, 0.001),
+            states.count('failed'), states.count('timeout')))
+        for source in sorted(self.totals):
+            states = [i[0] for i in self.status.values() if i[1] == source]
+            LOG.info('  %s: %d of %d region(s) moved' % (source, states.count('moved'), self.totals[source]))
+        for name, (state, source, target, spent, error) in sorted(self.status.items()):
+            if state != 'moved':
+                LOG.warn('  %-32s %-7s %s -> %s after %.1fs: %s' % (name, state, source, target, spent, error))
+
+
+def get_admin(args):
     # set up configuration
     params = dict(s.split('=', 1) for s in args.params if '=' in s)
     config = get_config(params, args.zk_hosts)
 
     # set up admin instance
-    admin = org.apache.hadoop.hbase.client.HBaseAdmin(config)
+    return config, org.apache.hadoop.hbase.client.HBaseAdmin(config)
 
-    for source in sources:
-        # set up list of online servers
-        source, targets = get_servers(admin, source, targets)
+def get_scheduler(args, admin):
+    placement = args.placement == 'load' and LoadPlacement(admin) or None
+    warmer = args.warm != 'none' and RegionWarmer(admin, args.warm_threads, args.warm, args.warm_rows, args.warm_family, args.warm_time) or None
 
-        # verify targets available
-        if not targets:
-            raise RuntimeError('No target servers available to receive regions')
+    return MoveScheduler(admin, args.parallel, args.per_target, placement, warmer)
 
-        # set up list of regions on the source
-        regions = get_regions(config, source)
+def save_regions(path, scheduler):
+    moved = sorted((i[1].split(',')[0], k) for k, i in scheduler.status.items() if i[0] == 'moved')
+
+    data = open('%s.part' % path, 'w')
+    try:
+        data.write(''.join('%s %s\n' % i for i in moved))
+    finally:
+        data.close()
+    os.rename('%s.part' % path, path)
 
-        # disable region balancer
-        LOG.info('Disabling automatic region balancer')
-        admin.balanceSwitch(False)
+    LOG.info('Saved %d moved region(s) to %s' % (len(moved), path))
 
-        if not args.dontmove:
-            LOG.info('Moving %d region(s) from %s to %d other server(s)' % (len(regions), source, len(targets)))
-            for count in xrange(len(regions)):
-                region = regions[count]
-                target = targets[count % len(targets)]
+def load_regions(args, sources):
+    config, admin = get_admin(args)
 
-                LOG.info('moving region %-32s (%4d of %4d) to server=%s' % (region.getEncodedName(), count + 1, len(regions), target))
-                try:
-                    move_region(admin, region, source, target)
-                except java.lang.reflect.UndeclaredThrowableException, e:
-                    LOG.error('Exception moving %s; split/moved? %s' % (region.getEncodedName(), e))
+    # set up list of saved regions for the requested hosts
+    saved = dict(line.split()[::-1] for line in open(args.region_file) if line.strip())
+    saved = dict((k, v) for k, v in saved.items() if v in sources)
+
+    # set up list of online servers
+    servers = dict((s.getServerName().split(',')[0], s.getServerName()) for s in admin.getClusterStatus().getServerInfo())
+    for host in sources:
+        if host not in servers:
+            raise RuntimeError('%s is not online' % host)
+
+    # find where every saved region lives now
+    jobs = []
+    for server in servers.values():
+        for region in get_regions(config, server):
+            host = saved.pop(region.getEncodedName(), None)
+            if host is not None and server != servers[host]:
+                jobs.append((region, server, [servers[host]]))
+
+    for name in sorted(saved):
+        LOG.warn('Saved region %s is no longer online; split or merged?' % name)
+
+    # disable region balancer
+    LOG.info('Disabling automatic region balancer')
+    admin.balanceSwitch(False)
+
+    LOG.info('Loading %d region(s) back onto %d server(s)' % (len(jobs), len(sources)))
+    scheduler = get_scheduler(args, admin)
+    scheduler.run(jobs)
+    scheduler.summary()
+
+def unload_regions(args, sources, targets=[]):
+    config, admin = get_admin(args)
+
+    # set up list of online servers
+    sources, targets = get_servers(admin, sources, targets)
+
+    # verify targets available
+    if not targets:
+        raise RuntimeError('No target servers available to receive regions')
+
+    # set up list of regions on the sources
+    regions = dict((source, list(get_regions(config, source))) for source in sources)
+
+    # disable region balancer
+    LOG.info('Disabling automatic region balancer')
+    admin.balanceSwitch(False)
+
+    if not args.dontmove:
+        for source in sources:
+            LOG.info('Moving %d region(s) from %s to %d other server(s)' % (len(regions[source]), source, len(targets)))
+
+        # interleave sources so they all drain at once under the shared in-flight cap
+        jobs = []
+        for indx in xrange(max(len(i) for i in regions.values())):
+            jobs.extend((regions[s][indx], s, targets) for s in sources if indx < len(regions[s]))
+
+        scheduler = get_scheduler(args, admin)
+        scheduler.run(jobs)
+        scheduler.summary()
+
+        if args.region_file:
+            save_regions(args.region_file, scheduler)
 
-        if args.shutdown:
+    if args.shutdown:
+        for source in sources:
             LOG.info('Shutting down region server: %s' % source)
             admin.stopRegionServer(get_address(source, admin.getClusterStatus().getVersion() >= 2))
 
 
 if __name__ == '__main__':
-    parser = optparse.OptionParser(usage='%prog <-s|--src-host <host>>|<-S|--src-file <file>> [options] [target1] [target2] ...')
+    parser = optparse.OptionParser(usage='%prog <-s|--src-host <host>>|<-S|--src-file <file>> [options] [target1] [target2] ...\n       %prog <-s|--src-host <host>>|<-S|--src-file <file>> -l -f <file> [options]')
     parser.add_option('-z', '--zk-hosts', default=[], action='append',
                       help='list of zookeeper hosts')
     parser.add_option('-s', '--src-host', default=[], action='append',
@@ -210,6 +669,26 @@ if __name__ == '__main__':
                       help='shut down source hosts after migration')
     parser.add_option('-n', '--dontmove', default=False, action='store_true',
                       help='skip moving regions when shutting down')
+    parser.add_option('-P', '--parallel', default=1, type='int',
+                      help='number of region moves to keep in flight across all sources')
+    parser.add_option('-L', '--per-target', default=2, type='int',
+                      help='max in-flight moves per target server, 0 for unlimited')
+    parser.add_option('-m', '--placement', default='round-robin', choices=['round-robin', 'load'],
+                      help='target selection: round-robin or least loaded by region count and requests')
+    parser.add_option('-w', '--warm', default='probe', choices=['none', 'probe', 'rows', 'full'],
+                      help='block cache warm-up after each move: none, probe first row, first --warm-rows rows, or full scan')
+    parser.add_option('--warm-rows', default=1000, type='int',
+                      help='rows to read per region with --warm rows')
+    parser.add_option('--warm-family', default=[], action='append',
+                      help='column family to read with --warm rows/full, default all')
+    parser.add_option('--warm-time', default=None, type='int',
+                      help='warm-up time budget per region in seconds, default 10/30/300 for probe/rows/full')
+    parser.add_option('--warm-threads', default=2, type='int',
+                      help='number of regions to warm concurrently')
+    parser.add_option('-f', '--region-file',
+                      help='file to save moved regions to, or to load them back from')
+    parser.add_option('-l', '--load', default=False, action='store_true',
+                      help='move regions saved in --region-file back to the source hosts')
     parser.add_option('-D', '--params', default=[], action='append',
                       help='extra hbase configuration key=val params')
     args, opts = parser.parse_args()
@@ -226,12 +705,17 @@ if __name__ == '__main__':
         parser.error('--src-host or --src-file is required')
     if src_hosts.intersection(tgt_hosts):
         parser.error('overlapping values in source and target hosts')
+    if args.load and not (args.region_file and os.path.exists(args.region_file)):
+        parser.error('--load requires an existing --region-file')
 
     LOG = org.apache.commons.logging.LogFactory.getLog(os.path.basename(__file__))
     LOG.info('Logging started')
 
     try:
-        unload_regions(args, src_hosts, tgt_hosts)
+        if args.load:
+            load_regions(args, src_hosts)
+        else:
+            unload_regions(args, src_hosts, tgt_hosts)
     except RuntimeError, e:
         LOG.error(e.message)
         sys.exit(1)
@@ -3,6 +3,7 @@
 import argparse
 import datetime
 import itertools
+import multiprocessing.pool
 import os
 import re
 import subprocess
@@ -12,25 +13,121 @@ import textwrap
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
     pass
 
-def package_info(key, cache={}):
+def package_info(key, path='.', cache={}):
     try:
-        if not cache:
-            lines = subprocess.check_output(['dpkg-parsechangelog'], stderr=open(os.devnull, 'w')).split('\n')
+        if path not in cache:
+            lines = subprocess.check_output(['dpkg-parsechangelog'], cwd=path, stderr=open(os.devnull, 'w')).split('\n')
             items = [line.split(':', 1) for line in lines if line and not line.startswith(' ')]
-            cache.update(dict((k.lower(), v.strip()) for k, v in items))
+            cache[path] = dict((k.lower(), v.strip()) for k, v in items)
 
-        return cache.get(key)
+        return cache[path].get(key)
     except (OSError, subprocess.CalledProcessError):
         return ''
 
-def bump_version(suffix='', bump_major=False, bump_minor=False, bump_patch=False, no_bump=False):
+def git_changes(start, end, sources):
+    # one git log for the whole range, records and fields split on ascii separators so bodies can hold anything
+    git_cmd = ['git', 'log', '--no-merges', '--format=%h %s (%aN)%x1f%b%x1e', '%s..%s' % (start, end)]
+    git_cmd.extend(sources)
+
+    changes = []
+    for item in subprocess.check_output(git_cmd).split('\x1e'):
+        if item.strip():
+            line, body = item.lstrip('\n').split('\x1f', 1)
+            changes.append(tuple(line.strip().split(' ', 1)) + (body,))
+
+    return changes
+
+def git_history(start, end):
+    # every commit in the union of the package ranges, merges included so ancestry can be walked in memory
+    base = subprocess.check_output(['git', 'merge-base', '--octopus'] + list(start)).split()
+    git_cmd = ['git', '-c', 'core.quotePath=false', 'log', '--name-only', '--format=%x1e%H %P%x1f%h %s (%aN)%x1f%b%x1f', end, '--not'] + base
+
+    history = []
+    for item in subprocess.check_output(git_cmd).split('\x1e')[1:]:
+        head, line, body, files = item.split('\x1f', 3)
+        head = head.split()
+        history.append((head[0], head[1:], tuple(line.strip().split(' ', 1)) + (body,), [i for i in files.split('\n') if i]))
+
+    return history
+
+def package_changes(history, last, sources):
+    # anything reachable from the last release is already in the changelog
+    parents = dict((sha1, prev) for sha1, prev, change, files in history)
+    done = set()
+    todo = [last]
+    while todo:
+        sha1 = todo.pop()
+        if sha1 not in done:
+            done.add(sha1)
+            todo.extend(parents.get(sha1, []))
+
+    match = lambda name: any(i == '.' or name == i or name.startswith(i + '/') for i in sources)
+    return [change for sha1, prev, change, files in history
+            if sha1 not in done and len(prev) < 2 and any(match(i) for i in files)]
+
+def changelog_fill(text, width=75):
+    # perl format ^<<< fill as used by dch: split after whitespace or '-', chop words longer than the field
+    lines = ['  * ']
+    while True:
+        chop = None
+        size = 0
+        while size < len(text):
+            if text[size].isspace():
+                chop, item = size, size
+                if size == width:
+                    break
+            else:
+                if text[size] == '-':
+                    chop, item = size + 1, size + 1
+                if size == width:
+                    break
+            size += 1
+        if chop is None or size == len(text):
+            chop, item = size, size
+
+        lines[-1] = (lines[-1] + text[:item]).rstrip()
+        text = text[chop:].lstrip()
+        if not text:
+            return '\n'.join(lines)
+        lines.append('    ')
+
+def changelog_lines(changes, extract=None):
+    lines = []
+    for sha1, text, body in changes:
+        print '\tappending changelog message for %s ...' % sha1
+        lines.append('[%s] %s' % (sha1, text))
+
+        if extract:
+            bugs = re.findall('%s' % extract[0], body, re.IGNORECASE)
+            if bugs:
+                lines.append('  %s%s addressed:' % (extract[1].capitalize(), 's' if len(bugs) != 1 else ''))
+                for item in bugs:
+                    lines.append('    ' + extract[2].format(item=item))
+
+    # git hands out utf-8, the field width is counted in characters
+    return [changelog_fill(line.decode('utf-8', 'replace')) for line in lines]
+
+def changelog_append(lines, name='debian/changelog'):
+    if not lines:
+        return
+
+    text = open(name).read().split('\n')
+    indx = [i for i, line in enumerate(text) if line.startswith(' -- ')][0]
+    while not text[indx - 1].strip():
+        indx -= 1
+    text[indx:indx] = [line.encode('utf-8') for line in lines]
+
+    with open(name, 'w') as data:
+        data.write('\n'.join(text))
+
+def bump_version(suffix='', bump_major=False, bump_minor=False, bump_patch=False, no_bump=False, path='.'):
     types = {
         'ds': r'(?P<MAJOR>\d{8})\.(?P<PATCH>\d{3})(?P<EXTRA>.*)',
         'mm': r'(?P<MAJOR>\d+)\.(?P<MINOR>\d+)\.(?P<BUILD>\d+)(?:\.(?P<PATCH>\d+))?(?P<EXTRA>.*)',
     }
 
     for label, regex in types.items():
-        match = re.match(regex, package_info('version'))
+        match = re.match(regex, package_info('version', path))
         if match:
             if label == 'ds':
                 today = datetime.date.today().strftime('%Y%m%d')
@@ -64,7 +161,7 @@ def bump_version(suffix='', bump_major=False, bump_minor=False, bump_patch=False
 
                 version = v_fmt % tuple(v_arg) + (suffix.replace('_', '-').replace('~', '+') or match.group('EXTRA') or '')
 
-            if version != package_info('version'):
+            if version != package_info('version', path):
                 return version
             else:
                 raise RuntimeError('version not incremented')
@@ -75,7 +172,12 @@ def main(argv=sys.argv[1:]):
     parser = argparse.ArgumentParser(description='debian package release helper', formatter_class=CustomFormatter)
     parser.add_argument('-e', '--extra', default=[], nargs=2, action='append', metavar=('FILE', 'REGEX'),
                         help='extra files to update with specified regex with placeholders')
-    if bool(package_info('version')):
+    # packages mode always releases existing changelogs, see which options apply before building the parser
+    multi = argparse.ArgumentParser(add_help=False)
+    multi.add_argument('-M', '--packages', nargs='+')
+    multi = multi.parse_known_args(argv)[0].packages
+
+    if bool(package_info('version')) or multi:
         action = parser.add_mutually_exclusive_group()
         action.add_argument('-j', '--major', default=False, action='store_true',
                             help='force increment major number')
@@ -112,6 +214,8 @@ def main(argv=sys.argv[1:]):
                         help='skip updating debian changelog')
     parser.add_argument('-c', '--commit', default=False, action='store_true',
                         help='commit and tag new changelog')
+    parser.add_argument('-M', '--packages', nargs='+', metavar='DIR',
+                        help='release every package directory from one shared git history and commit them together')
     parser.add_argument('-g', '--sha1-range', default=['{last_sha1}', 'HEAD'], nargs=2, metavar=('START', 'END'),
                         help='git commit range with placeholders')
     parser.add_argument('-f', '--tag-format', default='{package}.{version}',
@@ -130,56 +234,97 @@ def main(argv=sys.argv[1:]):
     strings = {
         'this_sha1' : subprocess.check_output(['git', 'log', '-1', '--format=%H']).strip(),
         'branch'    : subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD']).strip(),
-        'version'   : package_info('version'),
-        'package'   : args.package or package_info('source'),
     }
-    if bool(package_info('version')):
+
+    if args.packages:
+        releases = release_packages(args, parser, strings)
+    else:
+        strings.update(release_strings(args, strings))
+        releases = [(strings, prepare_release(args, strings))]
+
+    if args.commit:
+        changed = list(itertools.chain.from_iterable(i[1] for i in releases))
+        message = [args.message.format(**i[0]) for i in releases]
+        if len(message) > 1:
+            message.insert(0, 'Releasing %s\n' % ', '.join(i[0]['tag'] for i in releases))
+
+        print 'updating git ...'
+        for name in changed:
+            print '\tadding changed file to git %s ...' % name
+            subprocess.check_output(['git', 'add', name])
+        print '\tcommitting changelog to git ...'
+        subprocess.check_output(['git', 'commit', '-m', '\n'.join(message)] + changed)
+        for strings, changed in releases:
+            print '\ttagging changelog in git ...'
+            subprocess.check_output(['git', 'tag', args.tag_format.format(**strings)])
+        print 'release prep complete, verify and push the changes and tag'
+
+def release_strings(args, strings, path='.'):
+    strings = dict(strings, version=package_info('version', path), package=path == '.' and args.package or package_info('source', path))
+    if bool(package_info('version', path)):
         strings['last_sha1'] = subprocess.check_output(['git', 'rev-list', '--no-merges', '-1', args.tag_format.format(**strings)]).strip()
     else:
         strings['last_sha1'] = subprocess.check_output(['git', 'rev-list', '--max-parents=0', 'HEAD']).strip()
-    strings['version']   = args.version or bump_version(args.append.format(**strings), args.major, args.minor, args.patch, args.no_bump)
+    strings['version']   = args.version or bump_version(args.append.format(**strings), args.major, args.minor, args.patch, args.no_bump, path)
     strings['tag']       = args.tag_format.format(**strings)
 
-    changed = ['debian/changelog']
+    return strings
 
-    if not args.no_dch:
-        if bool(package_info('version')):
-            print 'creating changelog entry for %s ...' % strings['version']
-            subprocess.check_output(['dch', '--controlmaint', '--force-bad-version', '--newversion', strings['version'], args.message.format(**strings)])
-        else:
-            print 'creating new changelog for %s ...' % strings['version']
-            subprocess.check_output(['dch', '--controlmaint', '--create', '--package', args.package, '--newversion', strings['version'], args.message.format(**strings)])
+def release_packages(args, parser, strings):
+    if args.package != parser.get_default('package') or args.version:
+        parser.error('--package and --version cannot be shared between --packages')
 
-        if not vars(args).get('skiplog', False):
-            git_cmd = ['git', 'log', '--no-merges', '--format=%h %s (%aN)', '%s..%s' % (args.sha1_range[0].format(**strings), args.sha1_range[1].format(**strings))]
-            git_cmd.extend(set(itertools.chain.from_iterable(args.sources)))
+    pool = multiprocessing.pool.ThreadPool(len(args.packages))
+    prefix = subprocess.check_output(['git', 'rev-parse', '--show-prefix']).strip()
 
-            changes = subprocess.check_output(git_cmd)
-        else:
-            changes = ''
+    def prepare(path):
+        if not package_info('version', path):
+            raise RuntimeError('no changelog found in %s' % path)
 
-        for line in reversed(changes.strip().split('\n')[::-1]):
-            if not line:
-                continue
-            else:
-                sha1, text = line.strip().split(' ', 1)
+        info = release_strings(args, strings, path)
+        sources = [os.path.normpath(os.path.join(prefix, path, i)) for i in set(itertools.chain.from_iterable(args.sources))]
+        return path, info, args.sha1_range[0].format(**info), sources
+
+    # one pass over the union of every package range, each package then picks its own commits out of it
+    packages = pool.map(prepare, args.packages)
+    history = []
+    if not args.skiplog and not args.no_dch:
+        history = git_history(set(i[2] for i in packages), args.sha1_range[1].format(**packages[0][1]))
+
+    def release(item):
+        path, info, start, sources = item
+        dist = args.release
+        if dist == parser.get_default('release'):
+            dist = package_info('distribution', path) or dist
+
+        return info, prepare_release(args, info, dist, path, package_changes(history, start, sources))
 
-            print '\tappending changelog message for %s ...' % sha1
-            subprocess.check_output(['dch', '--controlmaint', '--append', '[%s] %s' % (sha1, text)])
+    return pool.map(release, packages)
 
-            if args.extract:
-                text = subprocess.check_output(['git', 'show', '-s', '--format=%b', sha1])
-                bugs = re.findall('%s' % args.extract[0], text, re.IGNORECASE)
-                if bugs:
-                    subprocess.check_output(['dch', '--controlmaint', '--append', '  %s%s addressed:' % (args.extract[1].capitalize(), 's' if len(bugs) != 1 else '')])
-                    for item in bugs:
-                        subprocess.check_output(['dch', '--controlmaint', '--append', '    ' + args.extract[2].format(item=item)])
+def prepare_release(args, strings, release=None, path='.', changes=None):
+    changed = [os.path.normpath(os.path.join(path, 'debian/changelog'))]
 
+    if not args.no_dch:
+        if bool(package_info('version', path)):
+            print 'creating changelog entry for %s ...' % strings['version']
+            subprocess.check_output(['dch', '--controlmaint', '--force-bad-version', '--newversion', strings['version'], args.message.format(**strings)], cwd=path)
+        else:
+            print 'creating new changelog for %s ...' % strings['version']
+            subprocess.check_output(['dch', '--controlmaint', '--create', '--package', args.package, '--newversion', strings['version'], args.message.format(**strings)], cwd=path)
+
+        if vars(args).get('skiplog', False):
+            changes = []
+        elif changes is None:
+            changes = git_changes(args.sha1_range[0].format(**strings), args.sha1_range[1].format(**strings),
+                                  set(itertools.chain.from_iterable(args.sources)))
+
+        changelog_append(changelog_lines(changes, args.extract), changed[0])
 
         print 'finalizing changelog release for %s ...' % strings['version']
-        subprocess.check_output(['dch', '--maintmaint', '--release', '--force-distribution', '--distribution', args.release, ''])
+        subprocess.check_output(['dch', '--maintmaint', '--release', '--force-distribution', '--distribution', release or args.release, ''], cwd=path)
 
     for name, patt in args.extra:
+        name = os.path.normpath(os.path.join(path, name))
         print 'checking %s ...' % name
         part = '(?P<PATTERN>%s)' % patt.format(**dict( (i, '(?P<%s>.*?)' % i) for i in strings.keys()))
         text = open(name).read()
@@ -194,16 +339,7 @@ def main(argv=sys.argv[1:]):
                 data.write(text)
                 changed.append(name)
 
-    if args.commit:
-        print 'updating git ...'
-        for name in changed:
-            print '\tadding changed file to git %s ...' % name
-            subprocess.check_output(['git', 'add', name])
-        print '\tcommitting changelog to git ...'
-        subprocess.check_output(['git', 'commit', '-m', args.message.format(**strings)] + changed)
-        print '\ttagging changelog in git ...'
-        subprocess.check_output(['git', 'tag', args.tag_format.format(**strings)])
-        print 'release prep complete, verify and push the changes and tag'
+    return changed
 
 if __name__ == '__main__':
     main()
@@ -1,46 +1,194 @@
 #!/usr/bin/python
 
+import bisect
 import calendar
+import collections
 import datetime
-import isodate
+import glob
+import hashlib
+import json
+import math
+import multiprocessing
 import re
-import requests
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
+
+from stat import S_ISDIR
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # for i in ../*.jpg ; do ffmpeg -i $i -vf drawtext="text='$(stat -f '%SB' -t '%d/%m/%Y %H\:%M\:%S' $i)': fontfile=/Library/Fonts/AppleGothic.ttf: fontcolor=white@0.8: x=w-tw: y=h-th" txt-$(basename $i) ; done
 # ffmpeg -y -r 60 -start_number 1 -i txt-by_%05d.jpg -s 1920x1080 -vcodec libx264 -pix_fmt yuv420p backyard.mp4
 
 os.chdir(sys.path[0])
 
-def fetch_times(date):
-    data = {
-        'lat': '37.7701',
-        'lng': '-121.9188',
-#        'date': time.strftime('%Y-%m-%d', time.gmtime(time.mktime(date.timetuple()))),
-        'date': date.strftime('%Y-%m-%d'),
-        'formatted': '0',
-    }
+video = [
+    '-vf', r"setpts=N/60/TB, drawtext=text='%{metadata\:stamp}': fontfile=/Library/Fonts/AppleGothic.ttf: fontcolor=white@0.8: x=w-tw: y=h-th, scale=1280:720",
+    '-r', '60',
+    '-vcodec', 'libx264',
+    '-pix_fmt', 'yuv420p',
+]
+
+def solar_times(first, count, lat=37.7701, lng=-121.9188, zenith=96.0):
+    # noaa solar position for a run of days, zenith 96 is civil twilight, results are local naive datetimes
+    rad = math.radians
+    times = {}
+    for day in (first + datetime.timedelta(i) for i in range(count)):
+        t = (day.toordinal() + 1721425.0 - lng / 360 - 2451545.0) / 36525
+        l0 = (280.46646 + t * (36000.76983 + t * 0.0003032)) % 360
+        m = 357.52911 + t * (35999.05029 - t * 0.0001537)
+        e = 0.016708634 - t * (0.000042037 + t * 0.0000001267)
+        c = math.sin(rad(m)) * (1.914602 - t * (0.004817 + t * 0.000014)) + math.sin(rad(2 * m)) * (0.019993 - t * 0.000101) + math.sin(rad(3 * m)) * 0.000289
+        o = 125.04 - 1934.136 * t
+        apparent = l0 + c - 0.00569 - 0.00478 * math.sin(rad(o))
+        obliquity = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60 + 0.00256 * math.cos(rad(o))
+        decl = math.asin(math.sin(rad(obliquity)) * math.sin(rad(apparent)))
+
+        y = math.tan(rad(obliquity / 2)) ** 2
+        eqtime = 4 * math.degrees(y * math.sin(2 * rad(l0)) - 2 * e * math.sin(rad(m)) + 4 * e * y * math.sin(rad(m)) * math.cos(2 * rad(l0))
+                                  - 0.5 * y * y * math.sin(4 * rad(l0)) - 1.25 * e * e * math.sin(2 * rad(m)))
+        angle = math.cos(rad(zenith)) / (math.cos(rad(lat)) * math.cos(decl)) - math.tan(rad(lat)) * math.tan(decl)
+        angle = 4 * math.degrees(math.acos(max(-1, min(1, angle))))
 
-    resp = requests.get('https://api.sunrise-sunset.org/json', params=data).json()['results']
-#    dawn = datetime.datetime.fromtimestamp(calendar.timegm(isodate.parse_datetime(resp['astronomical_twilight_begin']).timetuple()))
-#    dusk = datetime.datetime.fromtimestamp(calendar.timegm(isodate.parse_datetime(resp['astronomical_twilight_end']).timetuple()))
-#    dawn = datetime.datetime.fromtimestamp(calendar.timegm(isodate.parse_datetime(resp['nautical_twilight_begin']).timetuple()))
-#    dusk = datetime.datetime.fromtimestamp(calendar.timegm(isodate.parse_datetime(resp['nautical_twilight_end']).timetuple()))
-    dawn = datetime.datetime.fromtimestamp(calendar.timegm(isodate.parse_datetime(resp['civil_twilight_begin']).timetuple()))
-    dusk = datetime.datetime.fromtimestamp(calendar.timegm(isodate.parse_datetime(resp['civil_twilight_end']).timetuple()))
+        noon = calendar.timegm(day.timetuple()) + (720 - 4 * lng - eqtime) * 60
+        times[day] = (datetime.datetime.fromtimestamp(noon - angle * 60), datetime.datetime.fromtimestamp(noon + angle * 60))
+
+    return times
+
+def fetch_times(date, cache={}):
+    # filled a month at a time, a build only computes the days it scans
+    if date.date() not in cache:
+        cache.update(solar_times(date.date(), 31))
+
+    return (date.date(),) + cache[date.date()]
+
+def list_dir(path):
+    if scandir is not None:
+        for item in scandir(path):
+            yield item.name, item.is_dir(), item.stat()
+    else:
+        for name in os.listdir(path):
+            stat = os.stat('%s/%s' % (path, name))
+            yield name, S_ISDIR(stat.st_mode), stat
 
-    return date.date(), dawn, dusk
+def load_index(name='frames.json'):
+    try:
+        with open(name) as data:
+            index = json.load(data)
+    except (IOError, ValueError):
+        index = {'dirs': {}, 'frames': []}
 
+    # only directories that are new or were written to since the last run are listed again
+    seen = {}
+    for path, isdir, stat in list_dir('.'):
+        if isdir and patt.match(path):
+            seen[path] = stat.st_mtime
 
-indx = 0
+    stale = set(path for path in index['dirs'] if seen.get(path) != index['dirs'][path])
+    fresh = [path for path in seen if seen[path] != index['dirs'].get(path)]
+    if not stale and not fresh:
+        return index
+
+    frames = [item for item in index['frames'] if item[0].split('/')[0] not in stale]
+    for path in fresh:
+        print '>>> indexing', path
+        for item, isdir, stat in list_dir(path):
+            if not isdir:
+                frames.append(['%s/%s' % (path, item), stat.st_mtime, stat.st_size])
+
+    index = {'dirs': seen, 'frames': sorted(frames, key=lambda k: (k[1], k[0]))}
+    with open('%s.part' % name, 'w') as data:
+        json.dump(index, data)
+    os.rename('%s.part' % name, name)
+
+    return index
+
+def query(index, first=None, last=None, weekdays=range(5), daylight=True):
+    # frames captured in [first, last) by bisecting the time ordered index, flagged by weekday and daylight window
+    stamps = [item[1] for item in index['frames']]
+    lo = bisect.bisect_left(stamps, time.mktime(first.timetuple())) if first else 0
+    hi = bisect.bisect_left(stamps, time.mktime(last.timetuple())) if last else len(stamps)
+
+    for path, stamp, size in index['frames'][lo:hi]:
+        date = datetime.datetime.fromtimestamp(stamp)
+        day, dawn, dusk = fetch_times(date)
+        yield path, date, dawn, dusk, date.weekday() in weekdays and (not daylight or dawn < date < dusk)
+
+def concat(items, name):
+    with open(name, 'w') as data:
+        data.write('ffconcat version 1.0\n')
+        for path, meta in items:
+            data.write("file '%s'\n" % os.path.abspath(path).replace("'", "'\\''"))
+            if meta:
+                data.write("file_packet_metadata 'stamp=%s'\n" % meta)
+
+    return name
+
+def encode(args):
+    # one ffmpeg per day, each frame carries its own timestamp into drawtext as packet metadata
+    frames, output, temp = args
+    part = '%s/.%s' % os.path.split(output)
+    subprocess.check_call([
+        'ffmpeg', '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', concat([(path, date.strftime('%b %d %Y %H:%M')) for path, date in frames], '%s/%s.txt' % (temp, os.path.basename(output))),
+    ] + video + [
+        part,
+    ], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    os.rename(part, output)
+
+def segment(day, frames):
+    # a day is only encoded again when its frames or the encoding settings change
+    key = hashlib.sha1(json.dumps([video, [(path, str(date)) for path, date in frames]])).hexdigest()[:16]
+    return 'segments/%s-%s.mp4' % (day.strftime('%Y%m%d'), key)
+
+def build(frames, output, temp):
+    days = collections.OrderedDict()
+    for path, date in frames:
+        days.setdefault(date.date(), []).append((path, date))
+
+    if not os.path.isdir('segments'):
+        os.mkdir('segments')
+
+    parts = [(segment(day, items), items) for day, items in days.items()]
+    todo = [(items, name, temp) for name, items in parts if not os.path.exists(name)]
+    print '>>> encoding %d of %d days' % (len(todo), len(parts))
+
+    pool = multiprocessing.Pool()
+    try:
+        pool.map(encode, todo)
+    finally:
+        pool.terminate()
+
+    for name, items in parts:
+        for stale in glob.glob('%s-*.mp4' % name.rsplit('-', 1)[0]):
+            if stale != name:
+                os.unlink(stale)
+
+    subprocess.check_call([
+        'ffmpeg', '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', concat([(name, None) for name, items in parts], '%s/segments.txt' % temp),
+        '-c', 'copy',
+        output,
+    ])
+
+
+frames = []
 patt = re.compile(r'\d{8}_\d{4}')
-mark = datetime.date.fromtimestamp(0)
 temp = tempfile.mkdtemp()
-fmtd = '%s/by_%%06d.jpg' % temp
 print '>>> created', temp
 
 try:
@@ -52,41 +200,20 @@ except:
     stop = None
 
 try:
-    for path in filter(lambda x: patt.match(x), sorted(os.listdir('.'), key=os.path.getmtime)):
-        for name in sorted(os.listdir(path)):
-            date = datetime.datetime.fromtimestamp(os.stat('%s/%s' % (path, name)).st_mtime)
-
-            if stop is not None and date.date() != stop.date():
-                print '\033[91m---\033[0m %s/%s (%s != %s)' % (path, name, date, stop)
-                continue
-
-            if mark < date.date():
-                mark, dawn, dusk = fetch_times(date)
-
-            if date.weekday() < 5 and date > dawn and date < dusk:
-#            if date > dawn and date < dusk:
-                indx += 1
-                print '\033[94m+++\033[0m %s/%s (%s < %s < %s)' % (path, name, dawn, date, dusk)
-                subprocess.check_call([
-#                print ' '.join([
-                    'ffmpeg',
-                    '-i', '%s/%s' % (path, name),
-                    '-vf', "drawtext=text='%s': fontfile=/Library/Fonts/AppleGothic.ttf: fontcolor=white@0.8: x=w-tw: y=h-th" % date.strftime(r'%b %d %Y %H\:%M'),
-                    fmtd % indx,
-#                ])
-                ], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
-            else:
-                print '\033[91m---\033[0m %s/%s (%s < %s < %s)' % (path, name, dawn, date, dusk)
+    if stop is not None:
+        first = datetime.datetime.combine(stop.date(), datetime.time())
+        found = query(load_index(), first, first + datetime.timedelta(1))
+    else:
+        found = query(load_index())
 
-    subprocess.check_call([
-        'ffmpeg', '-y',
-        '-r', '60',
-        '-i', fmtd,
-        '-s', '1280x720',
-        '-vcodec', 'libx264',
-        '-pix_fmt', 'yuv420p',
-        'backyard.mp4' if stop is None else stop.strftime('%Y%m%d.mp4'),
-    ])
+    for path, date, dawn, dusk, keep in found:
+        if keep:
+            frames.append((path, date))
+            print '\033[94m+++\033[0m %s (%s < %s < %s)' % (path, dawn, date, dusk)
+        else:
+            print '\033[91m---\033[0m %s (%s < %s < %s)' % (path, dawn, date, dusk)
+
+    build(frames, 'backyard.mp4' if stop is None else stop.strftime('%Y%m%d.mp4'), temp)
 finally:
     shutil.rmtree(temp)
     print '<<< removed', temp